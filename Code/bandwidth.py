@@ -0,0 +1,135 @@
+"""Leave-one-out selection of the bandwidth of Gaussian kernels without refitting.
+
+Squared distances between training rows are computed once, in blocks of rows, and shared by every candidate `sigma2`
+of a `kernel.KGauss`, so a whole grid of bandwidths is scored in a single pass over the data, e.g.
+
+    sigma2, scores = bandwidth.select_sigma2(y, X, [0.001, 0.01, 0.1], loss="crps")
+    cdf = nonparamcdf.kernel_cdf(kernel.KGauss(sigma2))
+"""
+import torch
+from typing import Iterable
+from .caching import cached_prop_scores
+TT = torch.Tensor
+
+
+def _sq_dists(X_block: TT, X: TT, sq_norms: TT, start: int) -> TT:
+    """Squared distances between a block of rows (starting at row start of X) and all rows of X."""
+    return (sq_norms[start:start+X_block.shape[0]].unsqueeze(1)-2*X_block @ X.T+sq_norms).clamp_(min=0)
+
+
+def _loo_kernel(sq_dists: TT, sigma2: float, start: int) -> TT:
+    """Gaussian kernel of a block of rows against all rows with each row's kernel on itself removed."""
+    K = torch.exp(-sq_dists/sigma2)
+    rows = torch.arange(K.shape[0])
+    K[rows, start+rows] = 0
+    return K
+
+
+def _prepare(y: TT, X: TT, sample_weight: TT):
+    """Get y, X and sample weights (unit weights if None) in double precision."""
+    X = X.to(torch.float64)
+    y = y.reshape(-1).to(torch.float64)
+    weights = torch.ones_like(y) if sample_weight is None else torch.as_tensor(sample_weight).to(torch.float64)
+    return y, X, weights
+
+
+def loo_mse(y: TT, X: TT, sigma2s: Iterable[float], sample_weight: TT = None, block_size=1024) -> TT:
+    """Leave-one-out mean squared error of `kernel_regressor` for each candidate bandwidth.
+
+    Each training row is predicted from all other rows (its own kernel value removed), matching `kernel_regressor`
+    without clamping.
+
+    Args:
+        y (torch.Tensor): y values.
+        X (torch.Tensor): x values (final dim is dimension of x values).
+        sigma2s (Iterable[float]): Candidate `sigma2` values of `kernel.KGauss`.
+        sample_weight (torch.Tensor, optional): Weight of each row (in the fit and the error). Defaults to None.
+        block_size (int, optional): Number of rows per block of the distance matrix. Defaults to 1024.
+
+    Returns:
+        torch.Tensor: Weighted mean squared error for each candidate (inf if a row has no other row within reach).
+    """
+    y, X, weights = _prepare(y, X, sample_weight)
+    sigma2s = list(sigma2s)
+    sq_norms = torch.sum(X**2, dim=1)
+    totals = torch.zeros(len(sigma2s), dtype=torch.float64)
+    for start in range(0, X.shape[0], block_size):
+        sq_dists = _sq_dists(X[start:start+block_size], X, sq_norms, start)
+        y_block = y[start:start+block_size]
+        for c, sigma2 in enumerate(sigma2s):
+            weighted = _loo_kernel(sq_dists, sigma2, start)*weights
+            norm = torch.sum(weighted, dim=1)
+            preds = (weighted @ y)/norm
+            errors = torch.where(norm > 0, (y_block-preds)**2, torch.inf)
+            totals[c] += torch.sum(weights[start:start+block_size]*errors)
+    return totals/torch.sum(weights)
+
+
+def loo_crps(y: TT, X: TT, sigma2s: Iterable[float], prop_func=None, sample_weight: TT = None,
+             block_size=1024) -> TT:
+    """Leave-one-out mean continuous ranked probability score of `kernel_cdf` for each candidate bandwidth.
+
+    The CRPS of the step CDF F fitted without row i is the integral of (F(t) - 1{t >= y_i})^2 over t, a sum over the
+    gaps between consecutive sorted y values.
+
+    Args:
+        y (torch.Tensor): y values.
+        X (torch.Tensor): x values (final dim is dimension of x values).
+        sigma2s (Iterable[float]): Candidate `sigma2` values of `kernel.KGauss`.
+        prop_func (Callable, optional): The propensity function of the CDF (already fitted). Defaults to None.
+        sample_weight (torch.Tensor, optional): Weight of each row (in the fit and the score). Defaults to None.
+        block_size (int, optional): Number of rows per block of the distance matrix. Defaults to 1024.
+
+    Returns:
+        torch.Tensor: Weighted mean CRPS for each candidate (inf if a row has no other row within reach).
+    """
+    y, X, weights = _prepare(y, X, sample_weight)
+    y_sorted, sort_indices = torch.sort(y)
+    X_sorted = X[sort_indices]
+    weights = weights[sort_indices]
+    # CDF weights include propensity scores as in `kernel_cdf`
+    cdf_weights = weights if prop_func is None else weights/cached_prop_scores(prop_func, X_sorted).to(torch.float64)
+    gaps = y_sorted[1:]-y_sorted[:-1]
+    sigma2s = list(sigma2s)
+    sq_norms = torch.sum(X_sorted**2, dim=1)
+    totals = torch.zeros(len(sigma2s), dtype=torch.float64)
+    for start in range(0, X_sorted.shape[0], block_size):
+        sq_dists = _sq_dists(X_sorted[start:start+block_size], X_sorted, sq_norms, start)
+        y_block = y_sorted[start:start+block_size]
+        # Indicator of each row's own y at or below each sorted y (constant on the gap after it)
+        above = (y_sorted[:-1] >= y_block.unsqueeze(1)).to(torch.float64)
+        for c, sigma2 in enumerate(sigma2s):
+            cumul = torch.cumsum(_loo_kernel(sq_dists, sigma2, start)*cdf_weights, dim=1)
+            norm = cumul[:, -1]
+            crps = torch.sum((cumul[:, :-1]/norm.unsqueeze(1)-above)**2*gaps, dim=1)
+            scores = torch.where(norm > 0, crps, torch.inf)
+            totals[c] += torch.sum(weights[start:start+block_size]*scores)
+    return totals/torch.sum(weights)
+
+
+def select_sigma2(y: TT, X: TT, sigma2s: Iterable[float], loss="mse", **kwargs):
+    """Choose the `kernel.KGauss` bandwidth minimising a leave-one-out loss.
+
+    Args:
+        y (torch.Tensor): y values.
+        X (torch.Tensor): x values (final dim is dimension of x values).
+        sigma2s (Iterable[float]): Candidate `sigma2` values.
+        loss (str, optional): "mse" (`loo_mse`, for `kernel_regressor`) or "crps" (`loo_crps`, for `kernel_cdf`).
+                              Defaults to "mse".
+        **kwargs: Additional arguments to pass to the loss.
+
+    Raises:
+        ValueError: Errors if the loss is unknown.
+
+    Returns:
+        float: The chosen sigma2,
+        torch.Tensor: Loss of each candidate.
+    """
+    sigma2s = list(sigma2s)
+    if loss == "mse":
+        scores = loo_mse(y, X, sigma2s, **kwargs)
+    elif loss == "crps":
+        scores = loo_crps(y, X, sigma2s, **kwargs)
+    else:
+        raise ValueError(f"Unknown loss {loss}, options are 'mse' and 'crps'.")
+    return sigma2s[int(torch.argmin(scores))], scores
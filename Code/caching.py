@@ -0,0 +1,355 @@
+"""Caching of evaluation results.
+
+`dedupe_rows` evaluates a function once per distinct query row and scatters the results back to the original rows
+(if asked to, or when looking rows up in and adding them to a bounded `row_cache` shared across calls).
+
+Setting `prop_cache` to a `row_cache` shares propensity scores between the fits of all learners, keyed by a content
+fingerprint of the x values and of the propensity model, e.g.
+
+    caching.prop_cache = caching.row_cache(maxsize=64)
+
+Similarly setting `gram_cache` shares kernel (Gram) matrices between learners evaluating the same kernel on the same
+data, e.g. when comparing estimators on one test set:
+
+    caching.gram_cache = caching.row_cache(maxsize=256, maxbytes=2**30)
+
+`gram_cache` and `cdf_cache` (nuisance CDF values kept by `dr_learner.precompute`) can also be a `disk_cache` of
+memory-mapped `.npy` files so results are reused across runs:
+
+    caching.gram_cache = caching.cdf_cache = caching.disk_cache("cache_dir", maxbytes=2**34)
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+TT = torch.Tensor
+
+# Cache of propensity scores used by `cached_prop_scores` (None disables caching)
+prop_cache = None
+# Cache of kernel matrices used by `cached_gram` (None disables caching)
+gram_cache = None
+# Cache of nuisance CDF values at the training points used by `dr_learner.precompute` (None disables caching)
+cdf_cache = None
+
+
+class row_cache:
+    """Bounded least recently used cache of per-row results, safe to share between threads.
+
+    A cache set on a learner holds the results of that fitted learner and is cleared when the learner is refit.
+    """
+    def __init__(self, maxsize=4096, maxbytes: int = None):
+        """Initialise an empty cache.
+
+        Args:
+            maxsize (int, optional): Maximum number of entries to keep. Defaults to 4096.
+            maxbytes (int, optional): Maximum total size (in bytes) of the tensors stored, entries larger than this
+                                      are not stored. Defaults to None (no limit).
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the result stored for a key (None if not stored), marking it as most recently used."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        """Store the result for a key, evicting the least recently used entries beyond maxsize (or maxbytes)."""
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= _nbytes(self._entries.pop(key))
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._entries[key] = value
+            self.nbytes += size
+            while len(self._entries) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes):
+                self.nbytes -= _nbytes(self._entries.popitem(last=False)[1])
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class disk_cache:
+    """Size bounded least recently used cache of tensors stored as `.npy` files in a directory.
+
+    Entries are named by a fingerprint of their key and loaded memory-mapped (copy-on-write), so the directory can be
+    reused across runs and shared between processes. Only single tensors can be stored.
+    """
+    def __init__(self, directory: str, maxbytes: int = None):
+        """Initialise the cache, creating the directory if needed.
+
+        Args:
+            directory (str): Directory to store entries in.
+            maxbytes (int, optional): Maximum total size (in bytes) of the stored files, the least recently used are
+                                      removed first. Defaults to None (no limit).
+        """
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, fingerprint(*key).hex()+".npy")
+
+    def get(self, key):
+        """Get the tensor stored for a key (None if not stored), marking it as most recently used."""
+        path = self._path(key)
+        try:
+            array = np.load(path, mmap_mode="c", allow_pickle=False)
+        except ValueError:
+            # Empty arrays cannot be memory-mapped
+            array = np.load(path, allow_pickle=False)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return torch.from_numpy(array)
+
+    def put(self, key, value: TT) -> None:
+        """Store the tensor for a key, removing the least recently used files beyond maxbytes."""
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            np.save(file, value.detach().cpu().numpy(), allow_pickle=False)
+        # Replaced atomically so other processes never read a partially written file
+        os.replace(temp_path, path)
+        if self.maxbytes is not None:
+            with self._lock:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            for name in os.listdir(self.directory):
+                if name.endswith(".npy"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def __len__(self):
+        return sum(name.endswith(".npy") for name in os.listdir(self.directory))
+
+
+def _nbytes(out) -> int:
+    """Total size in bytes of every tensor in a (possibly nested tuple/list/dict) output."""
+    if isinstance(out, torch.Tensor):
+        return out.element_size()*out.nelement()
+    if isinstance(out, (tuple, list)):
+        return sum(_nbytes(item) for item in out)
+    if isinstance(out, dict):
+        return sum(_nbytes(item) for item in out.values())
+    return 0
+
+
+def _take(out, index):
+    """Index the rows of every tensor in a (possibly nested tuple/list/dict) output."""
+    if isinstance(out, torch.Tensor):
+        return out[index]
+    if isinstance(out, (tuple, list)):
+        return type(out)(_take(item, index) for item in out)
+    if isinstance(out, dict):
+        return {key: _take(item, index) for key, item in out.items()}
+    return out
+
+
+def _stack(rows: list):
+    """Stack per-row outputs (as split by `_take` with an integer index) back into one output."""
+    first = rows[0]
+    if isinstance(first, torch.Tensor):
+        return torch.stack(rows)
+    if isinstance(first, (tuple, list)):
+        return type(first)(_stack([row[i] for row in rows]) for i in range(len(first)))
+    if isinstance(first, dict):
+        return {key: _stack([row[key] for row in rows]) for key in first}
+    return first
+
+
+def _copy(out):
+    """Copy every tensor in an output so cached rows do not keep (or share) the full result."""
+    if isinstance(out, torch.Tensor):
+        return out.clone()
+    if isinstance(out, (tuple, list)):
+        return type(out)(_copy(item) for item in out)
+    if isinstance(out, dict):
+        return {key: _copy(item) for key, item in out.items()}
+    return out
+
+
+def dedupe_rows(func, *rows: TT, cache: row_cache = None, dedupe=True, **kwargs):
+    """Evaluate a function once per distinct query row and scatter the results back to every row.
+
+    Finding the distinct rows sorts a copy of the query rows, so callers not expecting repeated rows can pass
+    `dedupe=False` to call func directly (rows are still de-duplicated when a cache is given).
+
+    Args:
+        func (Callable): Function called as `func(*rows_subset, **kwargs)` whose output (a tensor or a tuple, list or
+                         dict of tensors) has one row per query row.
+        *rows (torch.Tensor): Query tensors sharing their first dim, a query row is the combination of their rows.
+                              Only 1 or 2 dimensional tensors are de-duplicated, others are passed straight to func.
+        cache (row_cache, optional): Cache of per-row results to look rows up in and add new rows to.
+                                     Defaults to None.
+        dedupe (bool, optional): Whether to de-duplicate rows without a cache. Defaults to True.
+        **kwargs: Additional arguments to pass to func (also part of the cache key).
+
+    Returns:
+        Output of func for all rows.
+    """
+    n = rows[0].shape[0]
+    if n == 0 or (cache is None and not dedupe) or any(row.dim() not in (1, 2) for row in rows):
+        return func(*rows, **kwargs)
+    keys = torch.cat([row.reshape(n, -1).to(torch.float64) for row in rows], dim=1)
+    unique_keys, inverse = torch.unique(keys, dim=0, return_inverse=True)
+    n_unique = unique_keys.shape[0]
+    if n_unique == n and cache is None:
+        return func(*rows, **kwargs)
+    # First occurrence of each distinct row
+    first = torch.full((n_unique,), n, dtype=torch.long).scatter_reduce_(
+        0, inverse, torch.arange(n), reduce="amin")
+    unique_rows = [row[first] for row in rows]
+    if cache is None:
+        return _take(func(*unique_rows, **kwargs), inverse)
+
+    prefix = repr(sorted(kwargs.items()))
+    row_keys = [(prefix,)+tuple(row[i].numpy().tobytes() for row in unique_rows) for i in range(n_unique)]
+    results = [cache.get(key) for key in row_keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        missing_index = torch.tensor(missing, dtype=torch.long)
+        out = func(*(row[missing_index] for row in unique_rows), **kwargs)
+        for j, i in enumerate(missing):
+            results[i] = _copy(_take(out, j))
+            cache.put(row_keys[i], results[i])
+    return _take(_stack(results), inverse)
+
+
+def fingerprint(*values) -> bytes:
+    """Get a content fingerprint (blake2b digest) of tensors, arrays and other values (by their repr).
+
+    Args:
+        *values: Values to fingerprint together.
+
+    Returns:
+        bytes: The fingerprint.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for value in values:
+        if isinstance(value, torch.Tensor):
+            value = value.detach().cpu().numpy()
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            digest.update(repr((value.dtype.str, value.shape)).encode())
+            digest.update(value.data)
+        else:
+            digest.update(repr(value).encode())
+    return digest.digest()
+
+
+def cached_prop_scores(prop_func, X: TT) -> TT:
+    """Evaluate a propensity function on x values, reusing scores stored in `prop_cache` if it is set.
+
+    Models with a `fingerprint` method (e.g. `kernel_regressor`) are identified by their fitted state, so refitting
+    them invalidates their entries. Other callables are identified by identity and must not be changed while cached.
+
+    Args:
+        prop_func (Callable): The propensity function (already fitted).
+        X (torch.Tensor): x values to evaluate at (final dim is dimension of x values).
+
+    Returns:
+        torch.Tensor: Propensity score of each row of X.
+    """
+    cache = prop_cache
+    if cache is None:
+        return prop_func(X)
+    model_fingerprint = getattr(prop_func, "fingerprint", None)
+    if model_fingerprint is not None:
+        key, owner = (model_fingerprint(), fingerprint(X)), None
+    else:
+        # The entry keeps the function alive so its id is not reused while cached
+        key, owner = (id(prop_func), fingerprint(X)), prop_func
+    entry = cache.get(key)
+    if entry is None:
+        entry = (owner, _copy(prop_func(X)))
+        cache.put(key, entry)
+    return _copy(entry[1])
+
+
+def kernel_fingerprint(kernel) -> bytes:
+    """Get a content fingerprint of a kernel from its type and parameters."""
+    params = [item for name, value in sorted(vars(kernel).items()) for item in (name, value)]
+    return fingerprint(type(kernel).__name__, *params)
+
+
+def _gram(kernel, X1: TT, X2: TT) -> TT:
+    """Evaluate the kernel matrix, only evaluating one triangle when X1 equals X2 (e.g. CDFs at their training data)."""
+    same = X1 is X2 or (X1.shape == X2.shape and X1.dtype == X2.dtype and torch.equal(X1, X2))
+    if same and hasattr(kernel, "eval_symmetric"):
+        return torch.tensor(kernel.eval_symmetric(X1.numpy()))
+    return torch.tensor(kernel.eval(X1.numpy(), X2.numpy()))
+
+
+def cached_gram(kernel, X1: TT, X2: TT) -> TT:
+    """Evaluate the kernel matrix between two sets of x values, reusing matrices stored in `gram_cache` if it is set.
+
+    Args:
+        kernel (kernel.Kernel): The kernel, called using the eval method.
+        X1 (torch.Tensor): First x values (final dim is dimension of x values).
+        X2 (torch.Tensor): Second x values (final dim is dimension of x values).
+
+    Returns:
+        torch.Tensor: Kernel matrix with a row for each row of X1 and a column for each row of X2.
+    """
+    cache = gram_cache
+    if cache is None:
+        return _gram(kernel, X1, X2)
+    key = (kernel_fingerprint(kernel), fingerprint(X1), fingerprint(X2))
+    gram = cache.get(key)
+    if gram is None:
+        gram = _gram(kernel, X1, X2)
+        cache.put(key, gram)
+    # Callers may modify the matrix in place
+    return gram.clone()
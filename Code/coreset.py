@@ -0,0 +1,85 @@
+"""Compression of training samples into small weighted coresets by kernel herding.
+
+The selected rows and weights can be passed straight to the `fit` methods of the learners, e.g.
+
+    indices, weights, mmd = coreset.kernel_herding(y, X, 500, kernel.KGauss(1.))
+    cdf.fit(y[indices], X[indices], sample_weight=weights)
+
+For `pseudo_ipw`/`dr_learner` build a coreset for each arm and pass the weights as `sample_weight0`/`sample_weight1`.
+"""
+import numpy as np
+import torch
+from . import kernel
+TT = torch.Tensor
+
+
+def _joint_gram(kernel: kernel.Kernel, X1: np.ndarray, y1: np.ndarray, X2: np.ndarray, y2: np.ndarray,
+                y_sigma2: float) -> np.ndarray:
+    """Gram matrix of the product of the x kernel and a Gaussian kernel in y."""
+    return kernel.eval(X1, X2)*np.exp(-(y1[:, np.newaxis]-y2[np.newaxis, :])**2/y_sigma2)
+
+
+def kernel_herding(y: TT, X: TT, size: int, kernel: kernel.Kernel, y_sigma2: float = None, sample_weight: TT = None,
+                   reference_size: int = None, block_size=1024, seed: int = None):
+    """Select a weighted coreset of (x, y) rows by kernel herding.
+
+    Rows are compared with the product of the learner's x kernel and a Gaussian kernel in y. Each step greedily adds
+    the row that most reduces the MMD between the full set and the (uniformly weighted) selected rows, so rows may
+    be selected more than once and their weight is the number of times they were selected. Costs O(n (r + size))
+    kernel evaluations for n rows and a reference set of r rows.
+
+    Args:
+        y (torch.Tensor): y values of the full set.
+        X (torch.Tensor): x values of the full set (final dim is dimension of x values).
+        size (int): Number of herding steps (the number of distinct selected rows is at most this).
+        kernel (kernel.Kernel): Kernel on x values (e.g. the learner's `KGauss`).
+        y_sigma2 (float, optional): Squared length scale of the Gaussian kernel in y. Defaults to None (variance of y).
+        sample_weight (torch.Tensor, optional): Weight of each row of the full set. Defaults to None (unit weights).
+        reference_size (int, optional): Size of a random subsample used to estimate the mean embedding of the full
+                                        set. Defaults to None (use all rows).
+        block_size (int, optional): Number of rows per block when computing the mean embedding. Defaults to 1024.
+        seed (int, optional): Seed for drawing the reference subsample. Defaults to None.
+
+    Returns:
+        torch.Tensor: Indices of the selected rows,
+        torch.Tensor: Weight of each selected row (summing to the total weight of the full set),
+        float: MMD between the full set (its reference subsample if given) and the weighted coreset.
+    """
+    X_np = X.numpy()
+    y_np = y.reshape(-1).numpy().astype(np.float64)
+    n = y_np.shape[0]
+    weights_full = np.ones(n) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    if y_sigma2 is None:
+        y_sigma2 = np.var(y_np) if np.var(y_np) > 0 else 1.
+    if reference_size is not None and reference_size < n:
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+        reference = torch.randperm(n, generator=generator)[:reference_size].numpy()
+    else:
+        reference = np.arange(n)
+    reference_weights = weights_full[reference]/weights_full[reference].sum()
+
+    # Mean embedding of the full set evaluated at every row
+    mean_embedding = np.empty(n)
+    for start in range(0, n, block_size):
+        stop = min(start+block_size, n)
+        mean_embedding[start:stop] = _joint_gram(kernel, X_np[start:stop], y_np[start:stop], X_np[reference],
+                                                 y_np[reference], y_sigma2) @ reference_weights
+
+    selected = []
+    # Sum of kernel evaluations between every row and the rows selected so far
+    herd_sum = np.zeros(n)
+    for step in range(size):
+        index = int(np.argmax(mean_embedding-herd_sum/(step+1)))
+        selected.append(index)
+        herd_sum += _joint_gram(kernel, X_np, y_np, X_np[index:index+1], y_np[index:index+1], y_sigma2)[:, 0]
+    indices, counts = np.unique(selected, return_counts=True)
+    weights = counts/size
+
+    # MMD^2 = E_PP[k] - 2 E_PQ[k] + E_QQ[k] with P the full set and Q the coreset
+    mmd2 = (reference_weights @ mean_embedding[reference] - 2*weights @ mean_embedding[indices]
+            + weights @ _joint_gram(kernel, X_np[indices], y_np[indices], X_np[indices], y_np[indices],
+                                    y_sigma2) @ weights)
+    return (torch.from_numpy(indices), torch.from_numpy(weights*weights_full.sum()).to(X.dtype),
+            float(np.sqrt(max(mmd2, 0.))))
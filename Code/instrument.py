@@ -0,0 +1,128 @@
+"""Opt-in per-stage timing of learner calls.
+
+Learners have a `profiler` attribute (None by default). Setting it to a `profiler` records the wall time, number of
+calls and size of the main tensors of each named stage of their evaluation methods, e.g.
+
+    learner.profiler = instrument.profiler()
+    learner.predict(y0_new, X_new)
+    print(learner.profiler)
+
+With no profiler set stages reduce to entering and leaving a shared no-op context.
+"""
+import threading
+import time
+import torch
+
+
+class profiler:
+    """Accumulates wall time, call counts and tensor sizes per named stage."""
+    def __init__(self, synchronize=False):
+        """Initialise with no recorded stages.
+
+        Args:
+            synchronize (bool, optional): Whether to synchronise CUDA before reading the clock so asynchronous GPU
+                                          work is attributed to the stage that launched it. Defaults to False.
+        """
+        self.synchronize = synchronize
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, elements=0) -> None:
+        """Record one call of a stage.
+
+        Args:
+            name (str): Name of the stage.
+            seconds (float): Wall time of the call.
+            elements (int, optional): Number of elements of the tensors produced by the call. Defaults to 0.
+        """
+        with self._lock:
+            record = self.stages.setdefault(name, {"calls": 0, "seconds": 0., "elements": 0, "max_elements": 0})
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["elements"] += elements
+            record["max_elements"] = max(record["max_elements"], elements)
+
+    def reset(self) -> None:
+        """Discard all recorded stages."""
+        with self._lock:
+            self.stages = {}
+
+    def report(self) -> dict:
+        """Summarise the recorded stages.
+
+        Returns:
+            dict: Stage name mapped to its number of calls, total and mean wall time (seconds), total and largest
+            number of tensor elements per call, and share of the total recorded time.
+        """
+        with self._lock:
+            stages = {name: dict(record) for name, record in self.stages.items()}
+        total = sum(record["seconds"] for record in stages.values())
+        for record in stages.values():
+            record["mean_seconds"] = record["seconds"]/record["calls"]
+            record["fraction"] = record["seconds"]/total if total > 0 else 0.
+        return stages
+
+    def __str__(self):
+        lines = [f"{'stage':<20}{'calls':>8}{'total (s)':>12}{'mean (s)':>12}{'max elements':>14}{'share':>8}"]
+        for name, record in sorted(self.report().items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"{name:<20}{record['calls']:>8}{record['seconds']:>12.4g}{record['mean_seconds']:>12.4g}"
+                         f"{record['max_elements']:>14}{record['fraction']:>8.1%}")
+        return "\n".join(lines)
+
+
+class _null_stage:
+    """Stage used when no profiler is set, does nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, *tensors):
+        pass
+
+
+_NULL_STAGE = _null_stage()
+
+
+class _timed_stage:
+    """Stage timing its body and counting the elements of the tensors passed to `add`."""
+    def __init__(self, recorder: profiler, name: str):
+        self.recorder = recorder
+        self.name = name
+        self.elements = 0
+
+    def __enter__(self):
+        self._sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._sync()
+        self.recorder.add(self.name, time.perf_counter()-self.start, self.elements)
+        return False
+
+    def add(self, *tensors):
+        """Count the elements of tensors produced by the stage."""
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor):
+                self.elements += tensor.numel()
+
+    def _sync(self):
+        if self.recorder.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+
+def stage(recorder: profiler, name: str):
+    """Get a context manager timing a named stage.
+
+    Args:
+        recorder (profiler): Profiler to record to, or None to disable recording.
+        name (str): Name of the stage.
+
+    Returns:
+        Context manager whose `add` method counts the elements of the tensors produced by the stage.
+    """
+    if recorder is None:
+        return _NULL_STAGE
+    return _timed_stage(recorder, name)
@@ -7,6 +7,11 @@ from future.utils import with_metaclass
 __author__ = "wittawat"
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import hashlib
+import itertools
+import math
+import threading
 import numpy as np
 import scipy.signal as sig
 
@@ -48,6 +53,30 @@ class Kernel(with_metaclass(ABCMeta, object)):
         """Evaluate k(x1, y1), k(x2, y2), ..."""
         pass
 
+    def eval_symmetric(self, X, block_size=None, n_blocks=32, min_block=64):
+        """Evaluate the kernel on data X against itself.
+
+        Only blocks of rows on or above the diagonal are evaluated, the rest are
+        filled in by symmetry. With k blocks this evaluates a fraction
+        (k+1)/(2k) of eval(X, X), so the block size is chosen from the number
+        of rows (n_blocks blocks of at least min_block rows) unless given.
+        Falls back to eval(X, X) if there would only be a single block.
+        """
+        n = X.shape[0]
+        if block_size is None:
+            block_size = max(min_block, -(-n // n_blocks))
+        if block_size >= n:
+            return self.eval(X, X)
+        K = None
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            block = self.eval(X[start:stop], X[start:])
+            if K is None:
+                K = np.empty((n, n), dtype=block.dtype)
+            K[start:stop, start:] = block
+            K[start:, start:stop] = block.T
+        return K
+
 
 class KHoPoly(Kernel):
     """Homogeneous polynomial kernel of the form
@@ -64,6 +93,29 @@ class KHoPoly(Kernel):
     def pair_eval(self, X, Y):
         return np.sum(X * Y, 1) ** self.degree
 
+    def feature_map(self, X):
+        """
+        Explicit feature map phi with phi(x).dot(phi(y)) = (x.dot(y))**d, the
+        degree d monomials of x scaled by the square roots of their multinomial
+        coefficients.
+
+        Parameters
+        ----------
+        X : n x d numpy array
+
+        Return
+        ------
+        a n x (d+degree-1 choose degree) numpy array
+        """
+        (n, d) = X.shape
+        combos = list(itertools.combinations_with_replacement(range(d), self.degree))
+        features = np.empty((n, len(combos)), dtype=np.result_type(X, float))
+        for j, combo in enumerate(combos):
+            counts = np.bincount(combo, minlength=d)
+            coef = math.factorial(self.degree) / math.prod(math.factorial(c) for c in counts)
+            features[:, j] = np.sqrt(coef) * np.prod(X[:, list(combo)], axis=1)
+        return features
+
     def __str__(self):
         return "KHoPoly(d=%d)" % self.degree
 
@@ -75,6 +127,10 @@ class KLinear(Kernel):
     def pair_eval(self, X, Y):
         return np.sum(X * Y, 1)
 
+    def feature_map(self, X):
+        """Explicit feature map (the identity) with phi(x).dot(phi(y)) = x.dot(y)"""
+        return X
+
     def __str__(self):
         return "KLinear()"
 
@@ -132,6 +188,148 @@ class KGauss(Kernel):
         return "KGauss(w2=%.3f)" % self.sigma2
 
 
+# Partitions of recently used (training) rows by their discrete values, keyed by a
+# fingerprint of the discrete columns, shared by all KBlockGauss kernels
+_block_partitions = OrderedDict()
+_block_partitions_lock = threading.Lock()
+_MAX_BLOCK_PARTITIONS = 16
+
+
+def _block_partition(discrete):
+    """
+    Partition rows by their discrete values, reusing the partition of the same
+    rows from a previous call (e.g. the training rows of a learner).
+
+    Parameters
+    ----------
+    discrete : n x d_discrete numpy array
+
+    Return
+    ------
+    index : dict mapping the bytes of each distinct row of discrete values to its block
+    order : row indices sorted by block
+    bounds : start of each block (and end of the last) in order
+    """
+    discrete = np.ascontiguousarray(discrete + 0)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((discrete.dtype.str, discrete.shape)).encode())
+    digest.update(discrete.data)
+    key = digest.digest()
+    with _block_partitions_lock:
+        partition = _block_partitions.get(key)
+        if partition is not None:
+            _block_partitions.move_to_end(key)
+            return partition
+    keys, blocks = np.unique(discrete, axis=0, return_inverse=True)
+    blocks = blocks.reshape(-1)
+    order = np.argsort(blocks, kind="stable")
+    bounds = np.searchsorted(blocks[order], np.arange(keys.shape[0] + 1))
+    index = {row.tobytes(): b for b, row in enumerate(np.ascontiguousarray(keys))}
+    partition = (index, order, bounds)
+    with _block_partitions_lock:
+        _block_partitions[key] = partition
+        while len(_block_partitions) > _MAX_BLOCK_PARTITIONS:
+            _block_partitions.popitem(last=False)
+    return partition
+
+
+class KBlockGauss(Kernel):
+    """
+    Product of an exact matching kernel on the discrete columns and a Gaussian
+    kernel on the remaining columns. Rows with different discrete values have
+    kernel value 0, so eval only evaluates the Gaussian kernel within blocks of
+    rows with matching discrete values. The partition of X2 (the training rows
+    in the learners) is computed once and reused by later calls on the same
+    rows, only the query rows X1 are partitioned on each call. The Gram matrix
+    is returned dense (with zeros between blocks) so it still takes
+    O(n1 * n2) memory. A query row whose discrete values do not appear in X2
+    has an all-zero kernel row, the learners raise a ValueError for such rows
+    rather than normalising their weights to NaN.
+    """
+
+    def __init__(self, sigma2, discrete_cols):
+        assert sigma2 > 0, "sigma2 must be > 0"
+        self.sigma2 = sigma2
+        self.discrete_cols = tuple(discrete_cols)
+
+    def _split(self, X):
+        """Split the columns of X into discrete and continuous columns"""
+        discrete = np.zeros(X.shape[1], dtype=bool)
+        discrete[list(self.discrete_cols)] = True
+        return X[:, discrete], X[:, ~discrete]
+
+    def eval(self, X1, X2):
+        """
+        Evaluate the kernel on the two 2d numpy arrays.
+
+        Parameters
+        ----------
+        X1 : n1 x d numpy array
+        X2 : n2 x d numpy array
+
+        Return
+        ------
+        K : a n1 x n2 Gram matrix.
+        """
+        (n1, d1) = X1.shape
+        (n2, d2) = X2.shape
+        assert d1 == d2, "Dimensions of the two inputs must be the same"
+        discrete1, continuous1 = self._split(X1)
+        discrete2, continuous2 = self._split(X2)
+        index2, order2, bounds2 = _block_partition(discrete2)
+        # Blocks of the query rows, matched to the blocks of X2 by their discrete values
+        keys1, blocks1 = np.unique(np.ascontiguousarray(discrete1 + 0, dtype=discrete2.dtype), axis=0,
+                                   return_inverse=True)
+        blocks1 = blocks1.reshape(-1)
+        order1 = np.argsort(blocks1, kind="stable")
+        bounds1 = np.searchsorted(blocks1[order1], np.arange(keys1.shape[0] + 1))
+        gauss = KGauss(self.sigma2)
+        K = np.zeros((n1, n2), dtype=np.result_type(X1, X2, float))
+        for b1, key in enumerate(np.ascontiguousarray(keys1)):
+            b2 = index2.get(key.tobytes())
+            if b2 is None:
+                continue
+            rows = order1[bounds1[b1]:bounds1[b1 + 1]]
+            cols = order2[bounds2[b2]:bounds2[b2 + 1]]
+            K[np.ix_(rows, cols)] = gauss.eval(continuous1[rows], continuous2[cols])
+        return K
+
+    def eval_symmetric(self, X, block_size=None, n_blocks=32, min_block=64):
+        """
+        Evaluate the kernel on data X against itself, evaluating each block of
+        rows with matching discrete values with KGauss.eval_symmetric.
+        """
+        n = X.shape[0]
+        discrete, continuous = self._split(X)
+        _, order, bounds = _block_partition(discrete)
+        gauss = KGauss(self.sigma2)
+        K = np.zeros((n, n), dtype=np.result_type(X, float))
+        for b in range(bounds.shape[0] - 1):
+            rows = order[bounds[b]:bounds[b + 1]]
+            K[np.ix_(rows, rows)] = gauss.eval_symmetric(continuous[rows], block_size, n_blocks, min_block)
+        return K
+
+    def pair_eval(self, X, Y):
+        """
+        Evaluate k(x1, y1), k(x2, y2), ...
+
+        Parameters
+        ----------
+        X, Y : n x d numpy array
+
+        Return
+        -------
+        a numpy array with length n
+        """
+        discrete_X, continuous_X = self._split(X)
+        discrete_Y, continuous_Y = self._split(Y)
+        match = np.all(discrete_X == discrete_Y, axis=1)
+        return match * KGauss(self.sigma2).pair_eval(continuous_X, continuous_Y)
+
+    def __str__(self):
+        return "KBlockGauss(w2=%.3f, discrete=%s)" % (self.sigma2, self.discrete_cols)
+
+
 class KTriangle(Kernel):
     """
     A triangular kernel defined on 1D. k(x, y) = B_1((x-y)/width) where B_1 is the
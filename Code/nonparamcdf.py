@@ -8,6 +8,10 @@ from scipy.optimize import fsolve
 from abc import ABC
 from typing import Union
 from . import kernel
+from .utils import torch_normcdf
+from .instrument import stage
+from . import caching
+from .caching import dedupe_rows, fingerprint, kernel_fingerprint, cached_prop_scores, cached_gram
 TT = torch.Tensor
 zero = torch.tensor([0.])
 # %%
@@ -15,7 +19,17 @@ zero = torch.tensor([0.])
 
 class kernel_regressor(ABC):
     """A class to perform simple kernel regression with a specified kernel.
+
+    Repeated query rows are evaluated once (see `dedupe`) and setting `cache` to a `caching.row_cache` keeps
+    predictions for query rows across calls. For kernels with an explicit `feature_map` (e.g. `KLinear`, `KHoPoly`)
+    with fewer features than training rows, sums over the training data are aggregated over the features at fit so
+    predictions cost O(number of features) per query.
     """
+    cache = None
+    # Whether to evaluate repeated query rows only once, None (default) does unless the feature sums are used: finding
+    # repeated rows sorts the query rows, which is negligible next to kernel rows but not next to O(features) rows
+    dedupe = None
+
     def __init__(self, kernel: kernel.Kernel, min: float = -torch.inf, max: float = torch.inf) -> None:
         """Initialise the kernel regressor with the given kernel.
 
@@ -28,15 +42,31 @@ class kernel_regressor(ABC):
         self.min = min
         self.max = max
 
-    def fit(self, y: TT, X: TT) -> None:
+    def fit(self, y: TT, X: TT, sample_weight: TT = None, collapse=False) -> None:
         """Fit the kernel regressor to the given data.
 
         Args:
             y (torch.Tensor): y values to fit to.
             X (torch.Tensor): x values to fit to (final dim is dimension of x values)
+            sample_weight (torch.Tensor, optional): Weight of each row. Defaults to None (unit weights).
+            collapse (bool, optional): Whether to collapse duplicate (y, x) rows into single weighted rows
+                                       (giving the same estimates). Defaults to False.
         """
+        if self.cache is not None:
+            self.cache.clear()
+        sample_weight = _sample_weights(sample_weight, X)
+        if collapse:
+            y, X, sample_weight = _collapse_duplicates(y, X, sample_weight)
         self.y = y
         self.X = X
+        self.sample_weights = sample_weight
+        features = _features(self.kernel, X, X.shape[0])
+        if features is None:
+            self.feature_sums = None
+        else:
+            # Weighted sums of features of y times weights and of weights
+            self.feature_sums = (features.T @ (sample_weight*y).to(features.dtype),
+                                 features.T @ sample_weight.to(features.dtype))
 
     def get_y_weights(self, X_new: TT) -> TT:
         """Get weights (normalised kernels) for each y value given a new X value.
@@ -44,25 +74,44 @@ class kernel_regressor(ABC):
         Args:
             X_new (torch.Tensor): Tensor of new X values to get weights for.
 
+        Raises:
+            ValueError: Errors if a query row has zero total kernel weight on the training rows.
+
         Returns:
             torch.Tensor: Tensor of weights
         """
-        X_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X.numpy()))
-        return X_dists/torch.sum(X_dists, dim=1, keepdim=True)
+        X_dists = cached_gram(self.kernel, X_new, self.X)*self.sample_weights
+        normaliser = torch.sum(X_dists, dim=1, keepdim=True)
+        _check_normaliser(normaliser)
+        return X_dists/normaliser
 
     def predict(self, X_new: TT) -> TT:
         """Predict the y values for a given X value.
 
+        Duplicate rows of X_new are only evaluated once unless `dedupe` is off (see `dedupe`) and no `cache` is set.
+
         Args:
             X_new (torch.Tensor): Tensor of new X values to predict y values for (final dim is dim of x).
 
         Returns:
             torch.Tensor: Predicted y values for each X_new.
         """
-        X_dists = self.get_y_weights(X_new)
-        preds = torch.sum(X_dists*self.y, dim=1)
+        dedupe = self.dedupe if self.dedupe is not None else getattr(self, "feature_sums", None) is None
+        return dedupe_rows(self._predict, X_new, cache=self.cache, dedupe=dedupe)
+
+    def _predict(self, X_new: TT) -> TT:
+        if getattr(self, "feature_sums", None) is not None:
+            features_new = torch.as_tensor(self.kernel.feature_map(X_new.numpy()))
+            preds = (features_new @ self.feature_sums[0])/(features_new @ self.feature_sums[1])
+        else:
+            X_dists = self.get_y_weights(X_new)
+            preds = torch.sum(X_dists*self.y, dim=1)
         return torch.clamp(preds, min=self.min, max=self.max)
 
+    def fingerprint(self) -> bytes:
+        """Get a content fingerprint of the fitted regressor (kernel, output bounds and training data)."""
+        return fingerprint(kernel_fingerprint(self.kernel), self.min, self.max, self.y, self.X, self.sample_weights)
+
     predict_proba = predict
     __call__ = predict
 
@@ -123,9 +172,287 @@ class kernel_regressor_numpy(ABC):
     __call__ = predict
 
 
+def _features(kernel: kernel.Kernel, X: TT, max_dim: int):
+    """Get the explicit features of the rows of X for kernels exposing a `feature_map`.
+
+    Args:
+        kernel (kernel.Kernel): The kernel.
+        X (torch.Tensor): x values (final dim is dimension of x values).
+        max_dim (int): Features are only used if there are fewer than this many (e.g. the number of training rows).
+
+    Returns:
+        torch.Tensor: Features of each row (None if the kernel has no feature map or too many features).
+    """
+    feature_map = getattr(kernel, "feature_map", None)
+    if feature_map is None:
+        return None
+    features = torch.as_tensor(feature_map(X.numpy()))
+    return features if features.shape[-1] < max_dim else None
+
+
+def _sample_weights(sample_weight, X: TT) -> TT:
+    """Get sample weights for the rows of X as a tensor (unit weights if sample_weight is None)."""
+    if sample_weight is None:
+        return torch.ones_like(X[:, 0])
+    return torch.as_tensor(sample_weight).to(X.dtype)
+
+
+def _check_normaliser(normaliser: TT) -> None:
+    """Check every query row has kernel weight on the training rows (otherwise its normalised weights are NaN).
+
+    Raises:
+        ValueError: Errors if any query row has zero total kernel weight.
+    """
+    if torch.any(normaliser == 0):
+        raise ValueError("Some query rows have zero total kernel weight on the training rows, e.g. a category of a "
+                         "KBlockGauss discrete column that is not in the training data.")
+
+
+def _collapse_duplicates(y: TT, X: TT, sample_weight: TT):
+    """Collapse duplicate (y, x) rows into unique rows weighted by the total weight of their copies.
+
+    Args:
+        y (torch.Tensor): y values.
+        X (torch.Tensor): x values (final dim is dimension of x values).
+        sample_weight (torch.Tensor): Weight of each row.
+
+    Returns:
+        torch.Tensor: y values of unique rows,
+        torch.Tensor: x values of unique rows,
+        torch.Tensor: total weight of each unique row.
+    """
+    n = y.shape[0]
+    rows = torch.cat([y.reshape(n, 1).to(torch.float64), X.reshape(n, -1).to(torch.float64)], dim=1)
+    unique_rows, inverse = torch.unique(rows, dim=0, return_inverse=True)
+    n_unique = unique_rows.shape[0]
+    # First occurrence of each unique row
+    first = torch.full((n_unique,), n, dtype=torch.long).scatter_reduce_(0, inverse, torch.arange(n), reduce="amin")
+    weights = torch.zeros(n_unique, dtype=sample_weight.dtype).index_add_(0, inverse, sample_weight)
+    return y[first], X[first], weights
+
+
+def _step_grid(y_sorted: TT, compress_ties: bool):
+    """Get the step points of sorted y values and the step point each value belongs to.
+
+    Args:
+        y_sorted (torch.Tensor): Sorted y values.
+        compress_ties (bool): Whether tied values share a single step point.
+
+    Returns:
+        torch.Tensor: Step points (y_sorted itself if not compress_ties),
+        torch.Tensor: Index of the step point of each value (None if not compress_ties).
+    """
+    if not compress_ties:
+        return y_sorted, None
+    return torch.unique_consecutive(y_sorted, return_inverse=True)
+
+
+def _group_steps(weights: TT, step_index: TT, n_steps: int) -> TT:
+    """Sum the columns (final dim) of weights belonging to the same step point (unchanged if step_index is None)."""
+    if step_index is None:
+        return weights
+    return weights.new_zeros(weights.shape[:-1]+(n_steps,)).index_add_(-1, step_index, weights)
+
+
+def _factor_cdfs(cdf_vals: TT, storage: str, rank: int = None):
+    """Store CDF values at a set of points (one row per point, one column per step point) as factors.
+
+    Args:
+        cdf_vals (torch.Tensor): CDF values.
+        storage (str): "dense" (the values themselves) or "svd" (truncated SVD of the given rank).
+        rank (int, optional): Rank of the truncated SVD (required for "svd"). Defaults to None.
+
+    Raises:
+        ValueError: Errors if the storage type is unknown or no rank is given for "svd".
+
+    Returns:
+        tuple: Factors of the values (see `_contract_cdfs`),
+        float: Relative Frobenius norm error of the factors.
+    """
+    if storage == "dense":
+        return (cdf_vals,), 0.
+    if storage == "svd":
+        if rank is None:
+            raise ValueError("rank must be given for svd storage.")
+        U, S, Vh = torch.linalg.svd(cdf_vals, full_matrices=False)
+        total = torch.sum(S**2)
+        error = torch.sqrt(torch.sum(S[rank:]**2)/total).item() if total > 0 else 0.
+        return (U[:, :rank]*S[:rank], Vh[:rank]), error
+    raise ValueError(f"Unknown storage {storage}, options are 'dense' and 'svd'.")
+
+
+def _cumulative_factors(cdf, X: TT) -> tuple:
+    """Factor the values of `cdf.getallcdfs(X)` through the cumulative step weights summed over the kernel features.
+
+    The values are the normalised features of X (points by features) times the cumulative step weights of the
+    training data summed over each feature (features by step points), i.e. the Gram matrix times a triangular matrix
+    of ones with the Gram matrix kept in its exact rank (number of features) factored form.
+
+    Args:
+        cdf (kernel_cdf): Fitted CDF with feature aggregates (see `kernel_cdf._set_feature_cdfs`).
+        X (torch.Tensor): x values (final dim is dimension of x values).
+
+    Raises:
+        ValueError: Errors if the CDF has no feature aggregates.
+
+    Returns:
+        tuple: Factors of the values (see `_contract_cdfs`).
+    """
+    if getattr(cdf, "feature_cdfs", None) is None:
+        raise ValueError("cumulative storage needs a CDF fitted with a kernel feature_map "
+                         "(with fewer features than training rows).")
+    cumul_sums, weight_sums = cdf.feature_cdfs
+    features = torch.as_tensor(cdf.kernel.feature_map(X.numpy())).to(cumul_sums.dtype)
+    return (features/(features @ weight_sums).unsqueeze(-1), cumul_sums)
+
+
+def _contract_cdfs(weights: TT, factors: tuple, storage: str) -> TT:
+    """Multiply weights (final dim over points) by CDF values stored as factors (see `dr_learner.precompute`)."""
+    out = weights @ factors[0].to(weights.dtype)
+    if storage in ("svd", "cumulative"):
+        return out @ factors[1].to(weights.dtype)
+    return out
+
+
+def _expand_cdfs(factors: tuple, storage: str) -> TT:
+    """Get the (dense) CDF values from factors stored by `dr_learner.precompute`."""
+    if storage in ("svd", "cumulative"):
+        return factors[0] @ factors[1]
+    return factors[0]
+
+
+def _select_steps(factors: tuple, index: TT) -> tuple:
+    """Restrict CDF values stored as factors (see `_contract_cdfs`) to the step point columns at index (0 gives 0)."""
+    padded = torch.cat([factors[-1].new_zeros(factors[-1].shape[0], 1), factors[-1]], dim=1)
+    return factors[:-1]+(padded[:, index],)
+
+
+def _lookup_feature_sums(features: TT, sums: TT, index: TT) -> TT:
+    """Contract each query's features with its column of cumulative sums over the features.
+
+    Args:
+        features (torch.Tensor): Features of each query row.
+        sums (torch.Tensor): Cumulative sums (features by step points).
+        index (torch.Tensor): Number of step points at or below each query (0 gives a value of 0).
+
+    Returns:
+        torch.Tensor: Contracted value of each query row (final dim of size 1).
+    """
+    padded = torch.cat([sums.new_zeros(sums.shape[0], 1), sums], dim=1)
+    return torch.sum(features.to(sums.dtype)*padded[:, index].T, dim=-1, keepdim=True)
+
+
+def _merge_positions(y_sorted: TT, y_new: TT):
+    """Get positions for merging new values into an already sorted tensor.
+
+    Existing values are placed before any new values they tie with.
+
+    Args:
+        y_sorted (torch.Tensor): Already sorted values.
+        y_new (torch.Tensor): New (unsorted) values to merge in.
+
+    Returns:
+        torch.Tensor: Positions of the existing values in the merged tensor,
+        torch.Tensor: Positions of the sorted new values in the merged tensor,
+        torch.Tensor: Indices which sort y_new.
+    """
+    y_new_sorted, new_order = torch.sort(y_new.to(y_sorted.dtype))
+    old_pos = torch.arange(y_sorted.shape[0]) + torch.searchsorted(y_new_sorted, y_sorted)
+    new_pos = torch.arange(y_new_sorted.shape[0]) + torch.searchsorted(y_sorted, y_new_sorted, right=True)
+    return old_pos, new_pos, new_order
+
+
+def _scatter_rows(old: TT, new: TT, old_pos: TT, new_pos: TT) -> TT:
+    """Combine rows of two tensors into one at the given (disjoint) positions along dim 0."""
+    out = old.new_empty((old.shape[0]+new.shape[0],)+tuple(old.shape[1:]))
+    out[old_pos] = old
+    out[new_pos] = new.to(old.dtype)
+    return out
+
+
+class sorted_sample:
+    """Training sample of one arm sorted by y with its propensity scores, fitted once and shared between learners.
+
+    Passing a sorted_sample as the y values of `kernel_cdf.fit` or the y0/y1 values of `pseudo_ipw.fit`/
+    `dr_learner.fit` (with None for the x values) reuses its sort and propensity scores instead of recomputing them.
+    Propensity scores are reused by learners with the same `prop_func` (A=0 arms use one minus them).
+    """
+    def __init__(self, y: TT, X: TT, prop_func=None, sample_weight: TT = None, collapse=False):
+        """Sort the sample and compute its propensity scores.
+
+        Args:
+            y (torch.Tensor): y values.
+            X (torch.Tensor): x values (final dim is dimension of x values).
+            prop_func (Callable, optional): The propensity function (already fitted). Defaults to None.
+            sample_weight (torch.Tensor, optional): Weight of each row. Defaults to None (unit weights).
+            collapse (bool, optional): Whether to collapse duplicate (y, x) rows into single weighted rows.
+                                       Defaults to False.
+        """
+        sample_weight = _sample_weights(sample_weight, X)
+        if collapse:
+            y, X, sample_weight = _collapse_duplicates(y, X, sample_weight)
+        self.y = y
+        self.X = X
+        self.sample_weights = sample_weight
+        self.y_sorted, self.sort_indices = torch.sort(y)
+        self.X_sorted = X[self.sort_indices]
+        self.prop_func = prop_func
+        self.prop_scores = _get_prop_scores(prop_func, X) if prop_func is not None else None
+
+    def get_prop_scores(self, prop_func=None) -> TT:
+        """Get the propensity scores of the rows (in the original order) under a propensity function.
+
+        Args:
+            prop_func (Callable, optional): The propensity function, the stored scores are reused if it is the one
+                                            the sample was built with. Defaults to None (scores of 0.5).
+
+        Returns:
+            torch.Tensor: Propensity score of each row.
+        """
+        if prop_func is not None and prop_func is self.prop_func:
+            return self.prop_scores
+        return _get_prop_scores(prop_func, self.X)
+
+
+def _get_prop_scores(prop_func, X: TT) -> TT:
+    """Get propensity scores of the rows of X (0.5 if prop_func is None), reusing `caching.prop_cache` if set."""
+    if prop_func is None:
+        return torch.ones_like(X[:, 0])-.5
+    return cached_prop_scores(prop_func, X)
+
+
+def _as_sample(y, X: TT, sample_weight: TT, collapse: bool) -> sorted_sample:
+    """Get the sorted sample for the data passed to a fit method (y may already be a sorted_sample).
+
+    Raises:
+        ValueError: Errors if a sorted_sample is passed along with x values, sample weights or collapse.
+    """
+    if not isinstance(y, sorted_sample):
+        return sorted_sample(y, X, sample_weight=sample_weight, collapse=collapse)
+    if X is not None or sample_weight is not None or collapse:
+        raise ValueError("x values, sample weights and collapse are set when building a sorted_sample, "
+                         "pass None/defaults to fit.")
+    return y
+
+
 # # Kernel Version ##
 class kernel_cdf(ABC):
-    """Class for kernel based cdf estimation"""
+    """Class for kernel based cdf estimation
+
+    Evaluation methods only modify the optional `cache` (under its lock), so a fitted instance can be shared between
+    threads. Setting `profiler` to an `instrument.profiler` records the time spent in each stage of evaluation,
+    repeated query rows are evaluated once (see `dedupe`) and setting `cache` to a `caching.row_cache` keeps the CDF
+    values of query rows across calls.
+    For kernels with an explicit `feature_map` (with fewer features than training rows) the cumulative step weights
+    are aggregated over the features at fit so `getallcdfs` and `cdf` do not form kernel matrices.
+    """
+    profiler = None
+    cache = None
+    # Whether to evaluate repeated query rows only once, None (default) does unless the feature aggregates are used:
+    # finding repeated rows sorts the query rows, which is negligible next to kernel rows but not O(features) rows
+    dedupe = None
+    # Whether to aggregate step weights over the kernel's explicit features if it has a feature map
+    use_feature_map = True
 
     def __init__(self, kernel: kernel.Kernel, prop_func=None, supremum=False):
         """Initialise the kernel type as well as the propensity function if necessary.
@@ -139,23 +466,104 @@ class kernel_cdf(ABC):
         self.kernel = kernel
         self.prop_func = prop_func
         self.supremum = supremum
-        self._in_inverse_cdf = False
 
-    def fit(self, y: TT, X: TT):
+    def fit(self, y: Union[TT, sorted_sample], X: TT, sample_weight: TT = None, collapse=False,
+            compress_ties=False):
         """Fit the CDF to the given data.
 
         Args:
-            y (torch.Tensor): y values to fit to.
+            y (torch.Tensor|sorted_sample): y values to fit to, or a sorted_sample of the data (with X None).
             X (torch.Tensor): x values to fit to (final dim is dimension of x values)
+            sample_weight (torch.Tensor, optional): Weight of each row. Defaults to None (unit weights).
+            collapse (bool, optional): Whether to collapse duplicate (y, x) rows into single weighted rows
+                                       (giving the same estimates). Defaults to False.
+            compress_ties (bool, optional): Whether tied y values share a single step point so step grid operations
+                                            scale with the number of distinct y values. Defaults to False.
         """
-        self.y = y
-        self.X = X
-        self.y_sorted, self.sort_indices = torch.sort(self.y)
-        self.X_sorted = self.X[self.sort_indices]
-        if self.prop_func is not None:
-            self.prop_scores = self.prop_func(self.X_sorted)
+        if self.cache is not None:
+            self.cache.clear()
+        sample = _as_sample(y, X, sample_weight, collapse)
+        self.y = sample.y
+        self.X = sample.X
+        self.y_sorted, self.sort_indices = sample.y_sorted, sample.sort_indices
+        self.X_sorted = sample.X_sorted
+        self.sample_weights = sample.sample_weights[self.sort_indices]
+        self.compress_ties = compress_ties
+        self.y_steps, self.step_index = _step_grid(self.y_sorted, compress_ties)
+        self.prop_scores = sample.get_prop_scores(self.prop_func)[self.sort_indices]
+        self._set_feature_cdfs()
+
+    def partial_fit(self, y: TT, X: TT, window: int = None, sample_weight: TT = None):
+        """Add new observations to the fitted CDF without re-sorting the existing data (fits it if not yet fitted).
+
+        New rows are merged into the sorted arrays and propensity scores are only computed for the new rows, so
+        sorting and propensity costs scale with the batch size. The tied step grid (with `compress_ties`) and feature
+        aggregates are rebuilt over all kept rows, which costs time linear in their number.
+
+        Args:
+            y (torch.Tensor): New y values to add.
+            X (torch.Tensor): New x values to add (final dim is dimension of x values)
+            window (int, optional): Maximum number of observations to keep, the oldest are evicted first.
+                                    Defaults to None (keep all).
+            sample_weight (torch.Tensor, optional): Weight of each new row. Defaults to None (unit weights).
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        if not hasattr(self, "y_sorted"):
+            self.fit(y, X, sample_weight)
         else:
-            self.prop_scores = torch.ones_like(self.X_sorted[:, 0])-.5
+            old_pos, new_pos, new_order = _merge_positions(self.y_sorted, y)
+            X_new_sorted = X[new_order]
+            sample_weight = _sample_weights(sample_weight, X)[new_order]
+            prop_scores_new = _get_prop_scores(self.prop_func, X_new_sorted)
+            self.y_sorted = _scatter_rows(self.y_sorted, y[new_order], old_pos, new_pos)
+            self.X_sorted = _scatter_rows(self.X_sorted, X_new_sorted, old_pos, new_pos)
+            self.prop_scores = _scatter_rows(self.prop_scores, prop_scores_new, old_pos, new_pos)
+            self.sample_weights = _scatter_rows(self.sample_weights, sample_weight, old_pos, new_pos)
+            # Sort indices refer to arrival order
+            self.sort_indices = _scatter_rows(self.sort_indices, new_order+self.y.shape[0], old_pos, new_pos)
+            self.y = torch.cat([self.y, y])
+            self.X = torch.cat([self.X, X])
+        if window is not None and self.y.shape[0] > window:
+            n_evict = self.y.shape[0]-window
+            keep = self.sort_indices >= n_evict
+            self.y_sorted = self.y_sorted[keep]
+            self.X_sorted = self.X_sorted[keep]
+            self.prop_scores = self.prop_scores[keep]
+            self.sample_weights = self.sample_weights[keep]
+            self.sort_indices = self.sort_indices[keep]-n_evict
+            self.y = self.y[n_evict:]
+            self.X = self.X[n_evict:]
+        self.y_steps, self.step_index = _step_grid(self.y_sorted, self.compress_ties)
+        self._set_feature_cdfs()
+
+    def _set_feature_cdfs(self):
+        """Aggregate the cumulative step weights over the kernel's explicit features (if it has a feature map)."""
+        self.feature_cdfs = None
+        if not self.use_feature_map:
+            return
+        features = _features(self.kernel, self.X_sorted, self.X_sorted.shape[0])
+        if features is None:
+            return
+        # Training row: dim 0, feature: dim 1
+        weighted = features*(self.sample_weights/self.prop_scores).to(features.dtype).unsqueeze(-1)
+        # Feature: dim 0, y_steps: dim 1
+        step_sums = _group_steps(weighted.T, self.step_index, self.y_steps.shape[0])
+        self.feature_cdfs = (torch.cumsum(step_sums, dim=-1), torch.sum(weighted, dim=0))
+
+    def _feature_cumulative(self, X_new: TT) -> TT:
+        """Get the CDF values at every step point from the feature aggregates (see `_set_feature_cdfs`)."""
+        with stage(self.profiler, "kernel") as timer:
+            features_new = torch.as_tensor(self.kernel.feature_map(X_new.numpy()))
+            cumul_sums, weight_sums = self.feature_cdfs
+            cumul_weights = (features_new @ cumul_sums)/(features_new @ weight_sums).unsqueeze(-1)
+            timer.add(cumul_weights)
+        return cumul_weights
+
+    def fingerprint(self) -> bytes:
+        """Get a content fingerprint of the fitted CDF (type, kernel and its parameters, and training data)."""
+        return fingerprint(type(self).__name__, kernel_fingerprint(self.kernel), getattr(self, "y_bandwidth", None),
+                           self.compress_ties, self.y_sorted, self.X_sorted, self.sample_weights, self.prop_scores)
 
     def get_y_weights(self, X_new: TT) -> TT:
         """Get weights for each y value given a new X value.
@@ -163,35 +571,56 @@ class kernel_cdf(ABC):
         Args:
             X_new (torch.Tensor): Tensor of new X values to get weights for.
 
+        Raises:
+            ValueError: Errors if a query row has zero total kernel weight on the training rows.
+
         Returns:
             torch.Tensor: Tensor of weights
         """
-        X_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X_sorted.numpy()))
-        # Re-adjust for propensity scores if necessary
-        X_dists = X_dists/self.prop_scores
-        # Normalise
-        X_dists = X_dists/torch.sum(X_dists, dim=1, keepdim=True)
+        with stage(self.profiler, "kernel") as timer:
+            X_dists = cached_gram(self.kernel, X_new, self.X_sorted)
+            # Re-adjust for sample weights and propensity scores if necessary
+            X_dists = X_dists*self.sample_weights/self.prop_scores
+            # Normalise
+            normaliser = torch.sum(X_dists, dim=1, keepdim=True)
+            _check_normaliser(normaliser)
+            X_dists = X_dists/normaliser
+            timer.add(X_dists)
         return X_dists
 
-    def getallcdfs(self, X_new: TT):
+    def getallcdfs(self, X_new: TT, inverse=False):
         """Get all CDF values and step points for each x value in X_new.
 
+        Duplicate rows of X_new are only evaluated once unless `dedupe` is off (see `dedupe`) and no `cache` is set.
+
         Args:
             X_new (torch.Tensor): Tensor of new X value to evaluate full CDF at.
+            inverse (bool, optional): Whether values are for use in inverse_cdf
+                                      (shifts values along by one step in supremum mode). Defaults to False.
 
         Returns:
             torch.Tensor: CDF values (final dim gives CDF values for each step),
             torch.Tensor: step points in y for these CDF values.
         """
-        y_weights = self.get_y_weights(X_new)
-        cumul_weights = torch.cumsum(y_weights, dim=-1)
+        dedupe = self.dedupe if self.dedupe is not None else getattr(self, "feature_cdfs", None) is None
+        cumul_weights = dedupe_rows(self._getallcdfs, X_new, cache=self.cache, dedupe=dedupe, inverse=inverse)
+        # Return weights and the change points they're associated with
+        return cumul_weights, self.y_steps
+
+    def _getallcdfs(self, X_new: TT, inverse=False) -> TT:
+        if getattr(self, "feature_cdfs", None) is not None:
+            cumul_weights = self._feature_cumulative(X_new)
+        else:
+            y_weights = self.get_y_weights(X_new)
+            with stage(self.profiler, "cumulative") as timer:
+                cumul_weights = torch.cumsum(_group_steps(y_weights, self.step_index, self.y_steps.shape[0]), dim=-1)
+                timer.add(cumul_weights)
         # A rearranging for the case of supremum which is only relevant for inverse cdf
-        if self.supremum and self._in_inverse_cdf:
+        if self.supremum and inverse:
             cumul_weights = torch.cat((
                 torch.zeros_like(cumul_weights[:, 0:1]),
                 cumul_weights[:, :cumul_weights.shape[1]-1]), dim=-1)
-        # Return weights and the change points they're associated with
-        return cumul_weights, self.y_sorted
+        return cumul_weights
 
     def cdf(self, y_new: TT, X_new: TT):
         """Evaluate CDF and give y, X pairs.
@@ -203,10 +632,26 @@ class kernel_cdf(ABC):
         Returns:
             torch.Tensor: CDF values for each y_new, X_new pair.
         """
+        if getattr(self, "feature_cdfs", None) is not None:
+            # X_new: dim ..., y_steps: dim -1
+            cumul_weights = self._feature_cumulative(X_new)
+            with stage(self.profiler, "indicator") as timer:
+                # Number of step points at or below each y_new (a value of 0 before the first step point)
+                step_counts = torch.searchsorted(self.y_steps, y_new.to(self.y_steps.dtype).contiguous(), right=True)
+                cumul_weights = torch.cat([cumul_weights.new_zeros(cumul_weights.shape[:-1]+(1,)), cumul_weights],
+                                          dim=-1)
+                shape = torch.broadcast_shapes(cumul_weights.shape[:-1], step_counts.shape)
+                cdf_vals = torch.gather(cumul_weights.expand(shape+cumul_weights.shape[-1:]), -1,
+                                        step_counts.expand(shape).unsqueeze(-1)).squeeze(-1)
+                timer.add(cdf_vals)
+            return cdf_vals
         # X_new: dim ..., X_sorted: dim -1
         y_weights = self.get_y_weights(X_new)
-        # y_new: dim ..., y_sorted: dim -1
-        return torch.sum(y_weights*(self.y_sorted <= y_new.unsqueeze(-1)), dim=-1)
+        with stage(self.profiler, "indicator") as timer:
+            # y_new: dim ..., y_sorted: dim -1
+            cdf_vals = torch.sum(y_weights*(self.y_sorted <= y_new.unsqueeze(-1)), dim=-1)
+            timer.add(cdf_vals)
+        return cdf_vals
 
     def inverse_cdf(self, alpha: Union[float, TT], X_new: TT):
         """Get inverse CDF values for a given alpha and X_new.
@@ -218,32 +663,170 @@ class kernel_cdf(ABC):
         Returns:
             torch.Tensor: Inverse CDF values for each alpha, X_new pair.
         """
-        # Set the flag for the altering of getallcdfs to in supremum inverse.
-        self._in_inverse_cdf = True
-        cdf_vals, _ = self.getallcdfs(X_new)
+        cdf_vals, y_steps = self.getallcdfs(X_new, inverse=True)
         if type(alpha) is float:
             alpha = torch.tensor([alpha])
-        y_expanded = self.y_sorted.unsqueeze(0).expand(X_new.shape[0], -1)
-
-        self._in_inverse_cdf = False
-        if not self.supremum:
-            valid_ys = torch.where(cdf_vals >= alpha.unsqueeze(-1),
-                                   y_expanded, torch.tensor([torch.inf]))
-
-            out_vals = torch.min(valid_ys, dim=-1)[0]
-            # Correct for cases with no valid value which currently output inf
-            # Instead output maximum of all ys
-            # (This theoretically should happen as the largest y-val should always have eCDF 1).
-            return torch.minimum(out_vals, self.y_sorted[-1])
-        else:
-            valid_ys = torch.where(cdf_vals <= alpha.unsqueeze(-1),
-                                   y_expanded, torch.tensor([-torch.inf]))
+        y_expanded = y_steps.unsqueeze(0).expand(X_new.shape[0], -1)
+
+        with stage(self.profiler, "inverse") as timer:
+            if not self.supremum:
+                valid_ys = torch.where(cdf_vals >= alpha.unsqueeze(-1),
+                                       y_expanded, torch.tensor([torch.inf]))
+
+                out_vals = torch.min(valid_ys, dim=-1)[0]
+                # Correct for cases with no valid value which currently output inf
+                # Instead output maximum of all ys
+                # (This theoretically should happen as the largest y-val should always have eCDF 1).
+                out_vals = torch.minimum(out_vals, y_steps[-1])
+            else:
+                valid_ys = torch.where(cdf_vals <= alpha.unsqueeze(-1),
+                                       y_expanded, torch.tensor([-torch.inf]))
+
+                out_vals = torch.max(valid_ys, dim=1)[0]
+                # Correct for cases with no valid value which currently output inf
+                # Instead output maximum of all ys
+                # (This theoretically should happen as the smallest y-val should always have eCDF 0).
+                out_vals = torch.maximum(out_vals, y_steps[0])
+            timer.add(valid_ys)
+        return out_vals
+
+    __call__ = cdf
+
+
+def _safeguarded_newton(func, lo: TT, hi: TT, x: TT, max_iter=50, tol=1e-6):
+    """Vectorised safeguarded Newton/bisection search for the root of non-decreasing functions.
+
+    Newton steps are taken where they stay strictly inside the current bracket, otherwise the bracket is bisected.
+
+    Args:
+        func (Callable(torch.Tensor)): Returns function values and derivatives at each point.
+        lo (torch.Tensor): Lower end of the bracket (function assumed negative here).
+        hi (torch.Tensor): Upper end of the bracket (function assumed non-negative here).
+        x (torch.Tensor): Starting points.
+        max_iter (int, optional): Maximum number of iterations. Defaults to 50.
+        tol (float, optional): Stop once no point moves by more than this. Defaults to 1e-6.
+
+    Returns:
+        torch.Tensor: Final iterate,
+        torch.Tensor: Final lower end of the bracket,
+        torch.Tensor: Final upper end of the bracket (smallest point found with non-negative value).
+    """
+    for _ in range(max_iter):
+        val, deriv = func(x)
+        above = val >= 0
+        hi = torch.where(above, x, hi)
+        lo = torch.where(above, lo, x)
+        newton = x - val/deriv
+        # NaN/inf steps from zero derivatives fail these comparisons and so bisect instead
+        use_newton = (deriv > 0) & (newton > lo) & (newton < hi)
+        x_next = torch.where(use_newton, newton, (lo+hi)/2)
+        converged = x.numel() == 0 or torch.max(torch.abs(x_next-x)) < tol
+        x = x_next
+        if converged:
+            break
+    return x, lo, hi
+
+
+class smooth_kernel_cdf(kernel_cdf):
+    """Kernel CDF estimate additionally smoothed in y with a Gaussian kernel.
+
+    The CDF is differentiable in y so inversion uses a safeguarded Newton search rather than scanning all step points.
+    """
+    # Smoothing in y is applied to the kernel weights so they are not aggregated over features
+    use_feature_map = False
+
+    def __init__(self, kernel: kernel.Kernel, y_bandwidth: float, prop_func=None, max_iter=50, tol=1e-6):
+        """Initialise the kernel type, y bandwidth and propensity function if necessary.
+
+        Args:
+            kernel (kernel.Kernel): The kernel to use for the cdf estimation. Called using the eval method.
+            y_bandwidth (float): Standard deviation of the Gaussian kernel used to smooth in y.
+            prop_func (Callable, optional): The propensity function. Defaults to None.
+            max_iter (int, optional): Maximum number of Newton iterations in inverse_cdf. Defaults to 50.
+            tol (float, optional): Tolerance (in y) for the Newton iterations in inverse_cdf. Defaults to 1e-6.
+        """
+        assert y_bandwidth > 0, "y_bandwidth must be > 0"
+        super().__init__(kernel, prop_func)
+        self.y_bandwidth = y_bandwidth
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def _getallcdfs(self, X_new: TT, inverse=False) -> TT:
+        """Get all CDF values at the step points of the unsmoothed CDF for each x value in X_new.
+
+        Args:
+            X_new (torch.Tensor): Tensor of new X value to evaluate full CDF at.
+            inverse (bool, optional): Unused as the smoothed CDF is continuous. Defaults to False.
+
+        Returns:
+            torch.Tensor: CDF values (final dim gives CDF values for each step).
+        """
+        y_weights = self.get_y_weights(X_new)
+        with stage(self.profiler, "cumulative") as timer:
+            # y_sorted (sample): dim 0, y_steps (step point): dim 1
+            smooth_steps = torch_normcdf((self.y_steps-self.y_sorted.unsqueeze(-1))/self.y_bandwidth)
+            cdf_vals = y_weights @ smooth_steps.to(y_weights.dtype)
+            timer.add(smooth_steps, cdf_vals)
+        return cdf_vals
+
+    def cdf(self, y_new: TT, X_new: TT):
+        """Evaluate CDF and give y, X pairs.
+
+        Args:
+            y_new (torch.Tensor): Tensor of new y values to evaluate CDF at.
+            X_new (torch.Tensor): Tensor of new X values to evaluate CDF at (final dimension is dimension of X).
+
+        Returns:
+            torch.Tensor: CDF values for each y_new, X_new pair.
+        """
+        y_weights = self.get_y_weights(X_new)
+        return torch.sum(y_weights*torch_normcdf((y_new.unsqueeze(-1)-self.y_sorted)/self.y_bandwidth), dim=-1)
+
+    def pdf(self, y_new: TT, X_new: TT):
+        """Evaluate the conditional density (derivative of the CDF in y) at y, X pairs.
+
+        Args:
+            y_new (torch.Tensor): Tensor of new y values to evaluate density at.
+            X_new (torch.Tensor): Tensor of new X values to evaluate density at (final dimension is dimension of X).
+
+        Returns:
+            torch.Tensor: Density values for each y_new, X_new pair.
+        """
+        y_weights = self.get_y_weights(X_new)
+        return torch.sum(y_weights*self._y_density((y_new.unsqueeze(-1)-self.y_sorted)), dim=-1)
+
+    def _y_density(self, y_diff: TT) -> TT:
+        return torch.exp(-(y_diff/self.y_bandwidth)**2/2)/(self.y_bandwidth*(2*torch.pi)**0.5)
+
+    def inverse_cdf(self, alpha: Union[float, TT], X_new: TT):
+        """Get inverse CDF values for a given alpha and X_new.
+
+        Args:
+            alpha (torch.Tensor): Porbability value(s) to get inverse CDF for.
+            X_new (torch.Tensor): X values to get inverse CDF for.
 
-            out_vals = torch.max(valid_ys, dim=1)[0]
-            # Correct for cases with no valid value which currently output inf
-            # Instead output maximum of all ys
-            # (This theoretically should happen as the smallest y-val should always have eCDF 0).
-            return torch.maximum(out_vals, self.y_sorted[0])
+        Returns:
+            torch.Tensor: Inverse CDF values for each alpha, X_new pair.
+        """
+        y_weights = self.get_y_weights(X_new)
+        alpha = torch.as_tensor(alpha, dtype=y_weights.dtype)
+        out_shape = torch.broadcast_shapes(alpha.shape, y_weights.shape[:1])
+        y_sorted = self.y_sorted.to(y_weights.dtype)
+
+        def root_func(y_opt):
+            y_diff = y_opt.unsqueeze(-1)-y_sorted
+            cdf_vals = torch.sum(y_weights*torch_normcdf(y_diff/self.y_bandwidth), dim=-1)
+            return cdf_vals-alpha, torch.sum(y_weights*self._y_density(y_diff), dim=-1)
+
+        # The smoothed CDF is (numerically) 0 and 1 well beyond the sample
+        lo = torch.full(out_shape, (y_sorted[0]-10*self.y_bandwidth).item(), dtype=y_weights.dtype)
+        hi = torch.full(out_shape, (y_sorted[-1]+10*self.y_bandwidth).item(), dtype=y_weights.dtype)
+        # Start at the conditional mean
+        start = torch.sum(y_weights*y_sorted, dim=-1).expand(out_shape).clone()
+        with stage(self.profiler, "root_find") as timer:
+            out_vals, _, _ = _safeguarded_newton(root_func, lo, hi, start, self.max_iter, self.tol)
+            timer.add(out_vals)
+        return out_vals
 
     __call__ = cdf
 
@@ -312,6 +895,9 @@ class exact_cdf(ABC):
 
 
 class pseudo_ipw(ABC):
+    # Set to an `instrument.profiler` to record the time spent in each stage of evaluation
+    profiler = None
+
     def __init__(self, kernel: kernel.Kernel, prop_func=None, normalisation=None):
         """Initalise the pseudo IPW model with the given kernel and propensity function.
 
@@ -328,27 +914,36 @@ class pseudo_ipw(ABC):
         self.prop_func = prop_func
         self.normalisation = "None" if normalisation is None else normalisation
 
-    def fit(self, y0: TT, X0: TT, y1: TT, X1: TT):
+    def fit(self, y0: Union[TT, sorted_sample], X0: TT, y1: Union[TT, sorted_sample], X1: TT,
+            sample_weight0: TT = None, sample_weight1: TT = None, collapse=False, compress_ties=False):
         """Fit the pseudo IPW model to the given data.
 
         Args:
-            y0 (torch.Tensor): y0 values to fit to.
+            y0 (torch.Tensor|sorted_sample): y0 values to fit to, or a sorted_sample of the A=0 data (with X0 None).
             X0 (torch.Tensor): x0 values to fit to (final dim is dimension of x values).
-            y1 (torch.Tensor): y1 values to fit to.
+            y1 (torch.Tensor|sorted_sample): y1 values to fit to, or a sorted_sample of the A=1 data (with X1 None).
             X1 (torch.Tensor): x1 values to fit to (final dim is dimension of x values).
+            sample_weight0 (torch.Tensor, optional): Weight of each A=0 row. Defaults to None (unit weights).
+            sample_weight1 (torch.Tensor, optional): Weight of each A=1 row. Defaults to None (unit weights).
+            collapse (bool, optional): Whether to collapse duplicate (y, x) rows into single weighted rows
+                                       (giving the same estimates). Defaults to False.
+            compress_ties (bool, optional): Whether tied y1 values share a single step point so step grid operations
+                                            scale with the number of distinct y1 values. Defaults to False.
         """
-        self.y0 = y0
-        self.X0 = X0
-        # Sort y1 and X1 for future use
-        self.y1_sorted, self.sort_indices_1 = torch.sort(y1)
-        self.X1_sorted = X1[self.sort_indices_1, :]
-        # Get propensity scores if necessary
-        if self.prop_func is not None:
-            self.prop_scores0 = 1-self.prop_func(self.X0)
-            self.prop_scores1 = self.prop_func(self.X1_sorted)
-        else:  # If no propensity scores then just use 0.5
-            self.prop_scores0 = torch.ones_like(self.X0[:, 0])-.5
-            self.prop_scores1 = torch.ones_like(self.X1_sorted[:, 0])-.5
+        sample0 = _as_sample(y0, X0, sample_weight0, collapse)
+        sample1 = _as_sample(y1, X1, sample_weight1, collapse)
+        self.y0 = sample0.y
+        self.X0 = sample0.X
+        self.sample_weights0 = sample0.sample_weights
+        # Sorted y1 and X1 for future use
+        self.y1_sorted, self.sort_indices_1 = sample1.y_sorted, sample1.sort_indices
+        self.X1_sorted = sample1.X_sorted
+        self.sample_weights1 = sample1.sample_weights[self.sort_indices_1]
+        self.compress_ties = compress_ties
+        self.y1_steps, self.step_index_1 = _step_grid(self.y1_sorted, compress_ties)
+        # Get propensity scores (0.5 if no propensity function)
+        self.prop_scores0 = 1-sample0.get_prop_scores(self.prop_func)
+        self.prop_scores1 = sample1.get_prop_scores(self.prop_func)[self.sort_indices_1]
 
     def get_y_weights(self, X_new):
         """Get weights for each y value given a new X value.
@@ -356,26 +951,33 @@ class pseudo_ipw(ABC):
         Args:
             X_new (torch.Tensor): Tensor of new X values to get weights for.
 
+        Raises:
+            ValueError: Errors if a query row has zero total kernel weight on the training rows.
+
         Returns:
             torch.Tensor: Tensor of weights
         """
-        X0_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X0.numpy()))
-        X1_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X1_sorted.numpy()))
-        if self.normalisation == "None":
-            normaliser_0 = normaliser_1 = (
-                torch.sum(X0_dists, dim=1, keepdim=True)
-                + torch.sum(X1_dists, dim=1, keepdim=True))
-        elif self.normalisation == "propensity":
-            normaliser_0 = normaliser_1 = (
-                torch.sum(X0_dists/self.prop_scores0, dim=1, keepdim=True)
-                + torch.sum(X1_dists/self.prop_scores1, dim=1, keepdim=True))
-        elif self.normalisation == "separate":
-            normaliser_0 = torch.sum(X0_dists/self.prop_scores0, dim=1, keepdim=True)
-            normaliser_1 = torch.sum(X1_dists/self.prop_scores1, dim=1, keepdim=True)
-
-        # Normalise
-        X0_dists.div_(normaliser_0)
-        X1_dists.div_(normaliser_1)
+        with stage(self.profiler, "kernel") as timer:
+            X0_dists = cached_gram(self.kernel, X_new, self.X0)*self.sample_weights0
+            X1_dists = cached_gram(self.kernel, X_new, self.X1_sorted)*self.sample_weights1
+            if self.normalisation == "None":
+                normaliser_0 = normaliser_1 = (
+                    torch.sum(X0_dists, dim=1, keepdim=True)
+                    + torch.sum(X1_dists, dim=1, keepdim=True))
+            elif self.normalisation == "propensity":
+                normaliser_0 = normaliser_1 = (
+                    torch.sum(X0_dists/self.prop_scores0, dim=1, keepdim=True)
+                    + torch.sum(X1_dists/self.prop_scores1, dim=1, keepdim=True))
+            elif self.normalisation == "separate":
+                normaliser_0 = torch.sum(X0_dists/self.prop_scores0, dim=1, keepdim=True)
+                normaliser_1 = torch.sum(X1_dists/self.prop_scores1, dim=1, keepdim=True)
+
+            # Normalise
+            _check_normaliser(normaliser_0)
+            _check_normaliser(normaliser_1)
+            X0_dists.div_(normaliser_0)
+            X1_dists.div_(normaliser_1)
+            timer.add(X0_dists, X1_dists)
         return X0_dists, X1_dists
 
     def get_single_h(self, y0_new, y1_new, X_new):
@@ -410,21 +1012,30 @@ class pseudo_ipw(ABC):
             torch.Tensor: y1 step points.
         """
         X0_dists, X1_dists = self.get_y_weights(X_new)
-        # Get contribution fo A=0 samples
-        term_0 = torch.sum(X0_dists*(self.y0 <= y0_new.unsqueeze(-1))/self.prop_scores0, dim=1, keepdim=True)
-        # Get contribution for A=1 samples for at all jumping points (i.e. y1 values)
-        term_1s = torch.cumsum(X1_dists/self.prop_scores1, dim=-1)
-        # Get value of h at each jumping point
-        hs = term_1s - term_0
-        return hs, self.y1_sorted
-
-    def predict(self, y0_new: TT, X_new: TT, sortcheck=True):
+        with stage(self.profiler, "term_0") as timer:
+            # Get contribution fo A=0 samples
+            term_0 = torch.sum(X0_dists*(self.y0 <= y0_new.unsqueeze(-1))/self.prop_scores0, dim=1, keepdim=True)
+            timer.add(term_0)
+        with stage(self.profiler, "cumulative") as timer:
+            # Get contribution for A=1 samples for at all jumping points (i.e. y1 values)
+            term_1s = torch.cumsum(_group_steps(X1_dists/self.prop_scores1, self.step_index_1,
+                                                self.y1_steps.shape[0]), dim=-1)
+            # Get value of h at each jumping point
+            hs = term_1s - term_0
+            timer.add(hs)
+        return hs, self.y1_steps
+
+    def predict(self, y0_new: TT, X_new: TT, sortcheck=False):
         """Give the g value for each y0_new, X_new pair.
 
+        Rather than forming all h values this finds, for each row, the first y1 step point at which the
+        cumulative A=1 term reaches the A=0 term via a binary search.
+
         Args:
             y0_new (torch.Tensor): New y0 value to predict g at.
             X_new (torch.Tensor): New X value to predict g at.
-            sortcheck (bool, optional): Whether to check if step points are already sorted. Defaults to True.
+            sortcheck (bool, optional): Whether to check if step points are already sorted
+                                        (they are guaranteed to be by `fit`). Defaults to False.
 
         Raises:
             ValueError: Errors if step points are not sorted.
@@ -432,22 +1043,46 @@ class pseudo_ipw(ABC):
         Returns:
             torch.Tensor: g values for each y0_new, X_new pair.
         """
-        hs, y1_candidate = self.get_all_hs(y0_new, X_new)
         if sortcheck:
-            if not torch.all(y1_candidate == torch.sort(y1_candidate)[0]):
+            if not torch.all(self.y1_sorted[1:] >= self.y1_sorted[:-1]):
                 raise ValueError("y1_candidate is not sorted.")
-        # Get y1s which give sufficiently large h/ have sufficiently large CDF
-        valid_ys = torch.where(hs >= 0, y1_candidate, torch.tensor([torch.inf]))
-        # Find the smallest valid y1
-        out_vals = torch.min(valid_ys, dim=1)[0]
-        # Correct for cases with no valid value which currently output inf
-        # Instead output maximum of all ys
+        X0_dists, X1_dists = self.get_y_weights(X_new)
+        with stage(self.profiler, "term_0") as timer:
+            # Get contribution fo A=0 samples
+            term_0 = torch.sum(X0_dists*(self.y0 <= y0_new.unsqueeze(-1))/self.prop_scores0, dim=1, keepdim=True)
+            timer.add(term_0)
+        with stage(self.profiler, "cumulative") as timer:
+            # Cumulative A=1 contribution, weights are non-negative so each row is non-decreasing in y1.
+            term_1s = _group_steps(torch.div(X1_dists, self.prop_scores1), self.step_index_1,
+                                   self.y1_steps.shape[0]).cumsum_(dim=-1)
+            timer.add(term_1s)
+        with stage(self.profiler, "root_find") as timer:
+            # First step point with h = term_1 - term_0 >= 0
+            first_valid = torch.searchsorted(term_1s, term_0.to(term_1s.dtype)).squeeze(-1)
+            timer.add(first_valid)
+        # Rows with no valid value output the maximum of all ys
         # (This theoretically should happen as the largest y-val should always have eCDF 1).
-        return torch.minimum(out_vals, y1_candidate[-1])
+        first_valid.clamp_(max=self.y1_steps.shape[0]-1)
+        return self.y1_steps[first_valid]
 
 
 class dr_learner(ABC):
-    def __init__(self, kernel: kernel.Kernel, cdf_0: kernel_cdf, cdf_1: kernel_cdf, prop_func=None):
+    # Set to an `instrument.profiler` to record the time spent in each stage of evaluation
+    profiler = None
+    # Set to a `caching.row_cache` to keep predictions for (y0, x) query rows across calls
+    cache = None
+    # Whether to evaluate repeated (y0, x) query rows only once, None (default) does unless the indicator terms are
+    # aggregated over kernel features (finding repeated rows sorts the query rows, negligible next to kernel rows)
+    dedupe = None
+    # Storage of `train_cdfs` (see `precompute`) and relative error of its approximation
+    cdf_storage = "dense"
+    cdf_storage_error = 0.
+    # Indicator terms of `get_all_hs` aggregated over the kernel's explicit features (see `fit`)
+    feature_indicators = None
+    # `train_cdfs` (and the values of `cdf_0` at the training points) aggregated over the features (see `precompute`)
+    feature_cdfs = None
+
+    def __init__(self, kernel: kernel.Kernel, cdf_0: kernel_cdf, cdf_1: kernel_cdf, prop_func=None, n_bins=None):
         """Initialise the DR learner with the given kernel and CDFs.
 
         Args:
@@ -456,33 +1091,295 @@ class dr_learner(ABC):
             cdf_1 (kernel_cdf): Estimated CDF for A=1 already fitted.
             prop_func (Callable(torch.Tensor, torch.Tensor), optional): Estimated propensity function already fitted.
                                                                         Defaults to None.
+            n_bins (int, optional): If given `get_all_hs` evaluates h only on a grid of n_bins+1 empirical quantiles
+                                    of the pooled y1 and `cdf_1` outcomes (an approximation, see `grid_error`), so
+                                    its y1 terms scale with the grid size rather than the number of step points.
+                                    Defaults to None (all step points).
         """
         self.kernel = kernel
         self.cdf_0 = cdf_0
         self.cdf_1 = cdf_1
         self.prop_func = prop_func
+        self.n_bins = n_bins
+        self.train_cdfs = None
 
-    def fit(self, y0: TT, X0: TT, y1: TT, X1: TT):
+    def fit(self, y0: Union[TT, sorted_sample], X0: TT, y1: Union[TT, sorted_sample], X1: TT,
+            sample_weight0: TT = None, sample_weight1: TT = None, collapse=False, compress_ties=False):
         """Fit the pseudo IPW model to the given data.
 
         Args:
-            y0 (torch.Tensor): y0 values to fit to.
+            y0 (torch.Tensor|sorted_sample): y0 values to fit to, or a sorted_sample of the A=0 data (with X0 None).
             X0 (torch.Tensor): x0 values to fit to (final dim is dimension of x values).
-            y1 (torch.Tensor): y1 values to fit to.
+            y1 (torch.Tensor|sorted_sample): y1 values to fit to, or a sorted_sample of the A=1 data (with X1 None).
             X1 (torch.Tensor): x1 values to fit to (final dim is dimension of x values).
+            sample_weight0 (torch.Tensor, optional): Weight of each A=0 row. Defaults to None (unit weights).
+            sample_weight1 (torch.Tensor, optional): Weight of each A=1 row. Defaults to None (unit weights).
+            collapse (bool, optional): Whether to collapse duplicate (y, x) rows into single weighted rows
+                                       (giving the same estimates). Defaults to False.
+            compress_ties (bool, optional): Whether tied y1 values share a single step point so step grid operations
+                                            scale with the number of distinct y1 values. Defaults to False.
         """
+        self.train_cdfs = None
+        self.feature_cdfs = None
+        if self.cache is not None:
+            self.cache.clear()
+        sample0 = _as_sample(y0, X0, sample_weight0, collapse)
+        sample1 = _as_sample(y1, X1, sample_weight1, collapse)
         self.y1_sorted: TT
-        self.y0 = y0
-        self.X0 = X0
-        self.y1_sorted, self.sort_indices_1 = torch.sort(y1)
-        self.X1_sorted = X1[self.sort_indices_1, :]
-        # Get propensity scores if necessary
-        if self.prop_func is not None:
-            self.prop_scores0 = 1-self.prop_func(self.X0)
-            self.prop_scores1 = self.prop_func(self.X1_sorted)
-        else:  # If no propensity scores then just use 0.5
-            self.prop_scores0 = torch.ones_like(self.X0[:, 0])-.5
-            self.prop_scores1 = torch.ones_like(self.X1_sorted[:, 0])-.5
+        self.y0 = sample0.y
+        self.X0 = sample0.X
+        self.sample_weights0 = sample0.sample_weights
+        self.y1_sorted, self.sort_indices_1 = sample1.y_sorted, sample1.sort_indices
+        self.X1_sorted = sample1.X_sorted
+        self.sample_weights1 = sample1.sample_weights[self.sort_indices_1]
+        self.compress_ties = compress_ties
+        self.y1_steps, self.step_index_1 = _step_grid(self.y1_sorted, compress_ties)
+        self._set_grid()
+        # Get propensity scores (0.5 if no propensity function)
+        self.prop_scores0 = 1-sample0.get_prop_scores(self.prop_func)
+        self.prop_scores1 = sample1.get_prop_scores(self.prop_func)[self.sort_indices_1]
+        self._set_feature_indicators()
+
+    def partial_fit(self, y0: TT, X0: TT, y1: TT, X1: TT, window: int = None, sample_weight0: TT = None,
+                    sample_weight1: TT = None):
+        """Add new observations to the fitted learner without re-sorting the existing data (fits it if not yet fitted).
+
+        New A=1 rows are merged into the sorted arrays and propensity scores are only computed for the new rows, so
+        sorting and propensity costs scale with the batch size. The tied step grid (with `compress_ties`), quantile
+        grid (with `n_bins`) and feature aggregates are rebuilt over all kept rows, which costs time linear in their
+        number (n log n for the quantile grid). Either arm can be skipped by passing None for its y and x values
+        once the learner is fitted.
+
+        Args:
+            y0 (torch.Tensor): New y0 values to add.
+            X0 (torch.Tensor): New x0 values to add (final dim is dimension of x values).
+            y1 (torch.Tensor): New y1 values to add.
+            X1 (torch.Tensor): New x1 values to add (final dim is dimension of x values).
+            window (int, optional): Maximum number of observations to keep in each arm, the oldest are evicted first.
+                                    Defaults to None (keep all).
+            sample_weight0 (torch.Tensor, optional): Weight of each new A=0 row. Defaults to None (unit weights).
+            sample_weight1 (torch.Tensor, optional): Weight of each new A=1 row. Defaults to None (unit weights).
+
+        Raises:
+            ValueError: Errors if an arm is skipped before the learner is fitted.
+        """
+        if not hasattr(self, "y1_sorted"):
+            if y0 is None or y1 is None:
+                raise ValueError("Both arms must be given to partial_fit an unfitted learner.")
+            self.fit(y0, X0, y1, X1, sample_weight0=sample_weight0, sample_weight1=sample_weight1)
+            if window is None:
+                return
+            # Both arms are fitted so only the window remains to be applied
+            y0 = y1 = None
+        self.train_cdfs = None
+        self.feature_cdfs = None
+        if self.cache is not None:
+            self.cache.clear()
+        if y0 is not None:
+            prop_scores0_new = 1-_get_prop_scores(self.prop_func, X0)
+            self.y0 = torch.cat([self.y0, y0])
+            self.X0 = torch.cat([self.X0, X0])
+            self.prop_scores0 = torch.cat([self.prop_scores0, prop_scores0_new.to(self.prop_scores0.dtype)])
+            self.sample_weights0 = torch.cat([self.sample_weights0,
+                                              _sample_weights(sample_weight0, X0).to(self.sample_weights0.dtype)])
+        if y1 is not None:
+            old_pos, new_pos, new_order = _merge_positions(self.y1_sorted, y1)
+            X1_new_sorted = X1[new_order, :]
+            prop_scores1_new = _get_prop_scores(self.prop_func, X1_new_sorted)
+            n1 = self.y1_sorted.shape[0]
+            self.y1_sorted = _scatter_rows(self.y1_sorted, y1[new_order], old_pos, new_pos)
+            self.X1_sorted = _scatter_rows(self.X1_sorted, X1_new_sorted, old_pos, new_pos)
+            self.prop_scores1 = _scatter_rows(self.prop_scores1, prop_scores1_new, old_pos, new_pos)
+            self.sample_weights1 = _scatter_rows(self.sample_weights1, _sample_weights(sample_weight1, X1)[new_order],
+                                                 old_pos, new_pos)
+            # Sort indices refer to arrival order
+            self.sort_indices_1 = _scatter_rows(self.sort_indices_1, new_order+n1, old_pos, new_pos)
+        if window is not None:
+            if self.y0.shape[0] > window:
+                n_evict = self.y0.shape[0]-window
+                self.y0 = self.y0[n_evict:]
+                self.X0 = self.X0[n_evict:]
+                self.prop_scores0 = self.prop_scores0[n_evict:]
+                self.sample_weights0 = self.sample_weights0[n_evict:]
+            if self.y1_sorted.shape[0] > window:
+                n_evict = self.y1_sorted.shape[0]-window
+                keep = self.sort_indices_1 >= n_evict
+                self.y1_sorted = self.y1_sorted[keep]
+                self.X1_sorted = self.X1_sorted[keep]
+                self.prop_scores1 = self.prop_scores1[keep]
+                self.sample_weights1 = self.sample_weights1[keep]
+                self.sort_indices_1 = self.sort_indices_1[keep]-n_evict
+        self.y1_steps, self.step_index_1 = _step_grid(self.y1_sorted, self.compress_ties)
+        self._set_grid()
+        self._set_feature_indicators()
+
+    def _set_grid(self):
+        """Set the quantile grid of y1 values used by `get_all_hs` when `n_bins` is given.
+
+        `grid_error` is the largest fraction of the pooled outcomes lying strictly between two adjacent grid points,
+        which bounds how far (in level of the pooled empirical CDF) a g value found on the grid can be from the step
+        point it would be on the full grid. The grid must be reset (by `fit`) if `cdf_1` is refit.
+        """
+        if self.n_bins is None:
+            self.y1_grid = None
+            self.grid_index_1 = None
+            self.grid_error = 0.
+            return
+        pooled = torch.sort(torch.cat([self.y1_sorted, self.cdf_1.y_sorted.to(self.y1_sorted.dtype)]))[0]
+        # Quantiles taken as observed values so grid points are step points
+        levels = torch.linspace(0, 1, self.n_bins+1, dtype=torch.float64)
+        self.y1_grid = torch.unique(pooled[(levels*(pooled.shape[0]-1)).round().long()])
+        between = (torch.searchsorted(pooled, self.y1_grid)[1:]
+                   - torch.searchsorted(pooled, self.y1_grid, right=True)[:-1])
+        self.grid_error = between.max().item()/pooled.shape[0] if between.numel() > 0 else 0.
+        # Grid bin of each sorted y1 value (the number of grid points below it)
+        self.grid_index_1 = torch.searchsorted(self.y1_grid, self.y1_sorted.to(self.y1_grid.dtype).contiguous())
+
+    def _cumulate_y1(self, weights: TT) -> TT:
+        """Sum weights (final dim over the sorted y1 values) cumulatively over the y1 step points (or grid with n_bins).
+
+        With `n_bins` the weights are first summed within each grid bin so the cumulative sum is over the grid only.
+        """
+        if self.y1_grid is None:
+            return torch.cumsum(_group_steps(weights, self.step_index_1, self.y1_steps.shape[0]), dim=-1)
+        n_grid = self.y1_grid.shape[0]
+        return torch.cumsum(_group_steps(weights, self.grid_index_1, n_grid+1), dim=-1)[..., :n_grid]
+
+    def _grid_cdfs(self, cdf_factors1: tuple, cdf_factors10: tuple, y1_cdf_candidate: TT):
+        """Restrict the stored CDF values at the training points to the y1 grid (unchanged without `n_bins`).
+
+        Values at each grid point are those at the last step point of `cdf_1` at or below it.
+
+        Returns:
+            tuple: Factors of the A=1 training point values,
+            tuple: Factors of the A=0 training point values,
+            torch.Tensor: y1 values of the columns.
+        """
+        if self.y1_grid is None:
+            return cdf_factors1, cdf_factors10, y1_cdf_candidate
+        cdf_index = torch.searchsorted(y1_cdf_candidate, self.y1_grid.to(y1_cdf_candidate.dtype), right=True)
+        return _select_steps(cdf_factors1, cdf_index), _select_steps(cdf_factors10, cdf_index), self.y1_grid
+
+    def precompute(self, storage="dense", rank: int = None):
+        """Compute and keep the values of `cdf_1` at the training points used by `get_all_hs`.
+
+        These do not depend on the query points so keeping them avoids recomputing them on every call, e.g. when
+        predicting in chunks. They are discarded by `fit`/`partial_fit` and must be recomputed if `cdf_1` is refit.
+        With `n_bins` only the values at the y1 grid points are kept. The row `cache` is cleared as the stored values
+        (and so the predictions) depend on `storage`.
+        If `caching.cdf_cache` is set (and `cdf_1` has a `fingerprint`) they are looked up in and added to it.
+        For kernels with an explicit `feature_map` (with fewer features than training rows) the values weighted by
+        the A=1 and A=0 pseudo-outcome weights are also summed over the features, as are the values of `cdf_0` if it
+        is a step `kernel_cdf`, so `get_all_hs` contracts the query features rather than query kernel weights with
+        them and (with the indicator sums from `fit`) costs O(number of features) per query and step point.
+
+        Args:
+            storage (str, optional): How to keep the values: "dense" matrices, a rank `rank` truncated "svd" (an
+                                     approximation with relative error `cdf_storage_error`) or exact "cumulative"
+                                     factors, the normalised kernel features of the points times the cumulative step
+                                     weights summed over the features (see `_cumulative_factors`, needs `cdf_1` to
+                                     have feature aggregates). `get_all_hs` contracts the query weights with the
+                                     stored factors. Defaults to "dense".
+            rank (int, optional): Rank of the truncated SVD (required for "svd"). Defaults to None.
+
+        Raises:
+            ValueError: Errors if the storage type is unknown, no rank is given for "svd" or `cdf_1` has no feature
+                        aggregates for "cumulative".
+        """
+        if storage not in ("dense", "svd", "cumulative"):
+            raise ValueError(f"Unknown storage {storage}, options are 'dense', 'svd' and 'cumulative'.")
+        if storage == "svd" and rank is None:
+            raise ValueError("rank must be given for svd storage.")
+        n_factors = 1 if storage == "dense" else 2
+        # Rows cached from the previous storage may differ (e.g. by the SVD truncation error)
+        if self.cache is not None:
+            self.cache.clear()
+        cache = caching.cdf_cache
+        key = None
+        if cache is not None and hasattr(self.cdf_1, "fingerprint"):
+            key = ("train_cdfs", storage, rank, self.cdf_1.fingerprint(),
+                   fingerprint(self.X1_sorted, self.X0, self.y1_grid))
+            cached = [cache.get(key+(i,)) for i in range(2*n_factors+2)]
+            if all(value is not None for value in cached):
+                self.cdf_storage = storage
+                self.cdf_storage_error = cached[-1].item()
+                self.train_cdfs = (tuple(cached[:n_factors]), tuple(cached[n_factors:2*n_factors]), cached[-2])
+                self._set_feature_cdfs()
+                return
+        if storage == "cumulative":
+            factors1 = _cumulative_factors(self.cdf_1, self.X1_sorted)
+            factors10 = _cumulative_factors(self.cdf_1, self.X0)
+            y1_cdf_candidate = self.cdf_1.y_steps
+            error1 = error10 = 0.
+        else:
+            all_cdf_vals1, y1_cdf_candidate = self.cdf_1.getallcdfs(self.X1_sorted)
+            all_cdf_vals10 = self.cdf_1.getallcdfs(self.X0)[0]
+            factors1, error1 = _factor_cdfs(all_cdf_vals1, storage, rank)
+            factors10, error10 = _factor_cdfs(all_cdf_vals10, storage, rank)
+        factors1, factors10, y1_cdf_candidate = self._grid_cdfs(factors1, factors10, y1_cdf_candidate)
+        self.cdf_storage = storage
+        self.cdf_storage_error = max(error1, error10)
+        self.train_cdfs = (factors1, factors10, y1_cdf_candidate)
+        self._set_feature_cdfs()
+        if key is not None:
+            values = factors1+factors10+(y1_cdf_candidate, torch.tensor(self.cdf_storage_error))
+            for i, value in enumerate(values):
+                cache.put(key+(i,), value)
+
+    def _train_features(self):
+        """Get the explicit kernel features of the A=0 and A=1 training rows (None if not used, see `_features`)."""
+        n = self.X0.shape[0]+self.X1_sorted.shape[0]
+        features0 = _features(self.kernel, self.X0, n)
+        features1 = _features(self.kernel, self.X1_sorted, n)
+        if features0 is None or features1 is None:
+            return None, None
+        return features0, features1
+
+    def _set_feature_indicators(self):
+        """Sum the indicator terms of `get_all_hs` over the kernel's explicit features (if it has a feature map).
+
+        The sample weights over the propensity scores times the features are summed cumulatively over the y1 step
+        points (grid points with `n_bins`) and the sorted y0 values, so the indicator terms of a query only need its
+        features.
+        """
+        self.feature_indicators = None
+        features0, features1 = self._train_features()
+        if features0 is None:
+            return
+        weights0 = self.sample_weights0.to(features0.dtype)
+        weights1 = self.sample_weights1.to(features1.dtype)
+        # Feature: dim 0, y1 step (or grid) points: dim 1
+        indicator_sums1 = self._cumulate_y1(
+            (features1*(weights1/self.prop_scores1.to(features1.dtype)).unsqueeze(-1)).T)
+        y0_sorted, order0 = torch.sort(self.y0)
+        # Feature: dim 0, sorted y0: dim 1
+        indicator_sums0 = torch.cumsum(
+            (features0*(weights0/self.prop_scores0.to(features0.dtype)).unsqueeze(-1))[order0].T, dim=-1)
+        self.feature_indicators = (indicator_sums1, y0_sorted, indicator_sums0,
+                                   features0.T @ weights0+features1.T @ weights1)
+
+    def _set_feature_cdfs(self):
+        """Sum the kept training CDF values (and step `cdf_0` values) over the kernel's explicit features."""
+        self.feature_cdfs = None
+        if self.feature_indicators is None:
+            return
+        features0, features1 = self._train_features()
+        cdf_factors1, cdf_factors10, _ = self.train_cdfs
+        weights0 = self.sample_weights0.to(features0.dtype)
+        weights1 = self.sample_weights1.to(features1.dtype)
+        # Feature: dim 0, y1 step points of cdf_1: dim 1
+        cdf_sums1 = (_contract_cdfs((features1*(weights1*(1-1/self.prop_scores1)).unsqueeze(-1)).T, cdf_factors1,
+                                    self.cdf_storage)
+                     + _contract_cdfs((features0*weights0.unsqueeze(-1)).T, cdf_factors10, self.cdf_storage))
+        cdf_sums0 = None
+        if isinstance(self.cdf_0, kernel_cdf) and not isinstance(self.cdf_0, smooth_kernel_cdf):
+            # Step CDFs take the value at the last step point at or below y0, so the sums are looked up there
+            cdf_vals0 = self.cdf_0.getallcdfs(self.X0)[0].to(features0.dtype)
+            cdf_vals01 = self.cdf_0.getallcdfs(self.X1_sorted)[0].to(features1.dtype)
+            # Feature: dim 0, y0 step points of cdf_0: dim 1
+            cdf_sums0 = ((features0*(weights0*(1-1/self.prop_scores0)).unsqueeze(-1)).T @ cdf_vals0
+                         + (features1*weights1.unsqueeze(-1)).T @ cdf_vals01)
+        self.feature_cdfs = (cdf_sums1, cdf_sums0)
 
     def get_y_weights(self, X_new: TT):
         """Get weights (normalised kernels) for each y value given a new X value.
@@ -490,17 +1387,23 @@ class dr_learner(ABC):
         Args:
             X_new (torch.Tensor): Tensor of new X values to get weights for.
 
+        Raises:
+            ValueError: Errors if a query row has zero total kernel weight on the training rows.
+
         Returns:
             torch.Tensor: Tensor of weights
         """
-        X0_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X0.numpy()))
-        X1_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X1_sorted.numpy()))
-        normaliser = (
-            torch.sum(X0_dists, dim=1, keepdim=True)
-            + torch.sum(X1_dists, dim=1, keepdim=True))
-        # Normalise
-        X0_dists.div_(normaliser)
-        X1_dists.div_(normaliser)
+        with stage(self.profiler, "kernel") as timer:
+            X0_dists = cached_gram(self.kernel, X_new, self.X0)*self.sample_weights0
+            X1_dists = cached_gram(self.kernel, X_new, self.X1_sorted)*self.sample_weights1
+            normaliser = (
+                torch.sum(X0_dists, dim=1, keepdim=True)
+                + torch.sum(X1_dists, dim=1, keepdim=True))
+            # Normalise
+            _check_normaliser(normaliser)
+            X0_dists.div_(normaliser)
+            X1_dists.div_(normaliser)
+            timer.add(X0_dists, X1_dists)
         return X0_dists, X1_dists
 
     def get_single_h(self, y0_new: TT, y1_new: TT, X_new: TT):
@@ -539,6 +1442,22 @@ class dr_learner(ABC):
         h = term_1-term_0
         return h
 
+    def _term_0(self, y0_new: TT, X0_dists: TT, X1_dists: TT) -> TT:
+        """Get the A=0 term of `get_all_hs` (depending on y0_new only) from the query kernel weights."""
+        # # Get CDFs
+        # y0_new: dim ..., X0: dim -1.
+        cdf_vals0 = self.cdf_0.cdf(y0_new.unsqueeze(-1), self.X0)
+        # y0_new: dim ..., X0: dim -1.
+        cdf_vals01 = self.cdf_0.cdf(y0_new.unsqueeze(-1), self.X1_sorted)
+
+        # y0_new in dim ..., y0 in dim -1.
+        Z0 = (self.y0 <= y0_new.unsqueeze(-1)).float()
+        # # Get contribution of A=0 samples
+        # y/X_new: dim ..., empty: dim -1
+        # Get 0 Term (depending on y0_new)
+        return torch.sum(X0_dists*((Z0-cdf_vals0)/self.prop_scores0+cdf_vals0),
+                         dim=-1, keepdim=True)+torch.sum(X1_dists*cdf_vals01, dim=-1, keepdim=True)
+
     def get_all_hs(self, y0_new: TT, X_new: TT, isotonic=False, check_same=False, slow=False):
         """Get all h values for a given y0_new and X_new.
 
@@ -557,90 +1476,141 @@ class dr_learner(ABC):
         """
         same = False
         if check_same:
-            if torch.all(self.cdf_1.y_sorted == self.y1_sorted) and torch.all(self.cdf_1.X_sorted == self.X1_sorted):
+            # Step grids also have to match
+            if (self.y1_grid is None and getattr(self.cdf_1, "compress_ties", False) == self.compress_ties
+                    and torch.all(self.cdf_1.y_sorted == self.y1_sorted)
+                    and torch.all(self.cdf_1.X_sorted == self.X1_sorted)):
                 same = True
-        # # Get weights for each fitting sample y given our new sample.
-        # X_new: dim ..., X0/1_dists: dim -1.
-        X0_dists, X1_dists = self.get_y_weights(X_new)
-
-        # # Get CDFs
-        # y0_new: dim ..., X0: dim -1.
-        cdf_vals0 = self.cdf_0.cdf(y0_new.unsqueeze(-1), self.X0)
-        # y0_new: dim ..., X0: dim -1.
-        cdf_vals01 = self.cdf_0.cdf(y0_new.unsqueeze(-1), self.X1_sorted)
-
-        # y0_new in dim ..., y0 in dim -1.
-        Z0 = (self.y0 <= y0_new.unsqueeze(-1)).float()
-        # # Get contribution of A=0 samples
-        # y/X_new: dim ..., empty: dim -1
-        # Get 0 Term (depending on y0_new)
-        term_0 = torch.sum(X0_dists*((Z0-cdf_vals0)/self.prop_scores0+cdf_vals0),
-                           dim=-1, keepdim=True)+torch.sum(X1_dists*cdf_vals01, dim=-1, keepdim=True)
+        # Aggregates over the kernel's explicit features replace the query kernel weights where available
+        feature_indicators = None if slow else getattr(self, "feature_indicators", None)
+        feature_cdfs = getattr(self, "feature_cdfs", None) if getattr(self, "train_cdfs", None) is not None else None
+        features_only = feature_indicators is not None and feature_cdfs is not None and feature_cdfs[1] is not None
+        if feature_indicators is not None:
+            with stage(self.profiler, "kernel") as timer:
+                features_new = torch.as_tensor(self.kernel.feature_map(X_new.numpy()))
+                normaliser = (features_new @ feature_indicators[3]).unsqueeze(-1)
+                timer.add(features_new)
+        if not features_only:
+            # # Get weights for each fitting sample y given our new sample.
+            # X_new: dim ..., X0/1_dists: dim -1.
+            X0_dists, X1_dists = self.get_y_weights(X_new)
+
+        with stage(self.profiler, "nuisance_cdf0") as timer:
+            if features_only:
+                # Number of sorted y0 values and step points of cdf_0 at or below each y0_new
+                _, y0_sorted, indicator_sums0, _ = feature_indicators
+                y0_counts = torch.searchsorted(y0_sorted, y0_new.to(y0_sorted.dtype).contiguous(), right=True)
+                y0_steps = torch.searchsorted(self.cdf_0.y_steps, y0_new.to(self.cdf_0.y_steps.dtype).contiguous(),
+                                              right=True)
+                term_0 = (_lookup_feature_sums(features_new, indicator_sums0, y0_counts)
+                          + _lookup_feature_sums(features_new, feature_cdfs[1], y0_steps))/normaliser
+            else:
+                term_0 = self._term_0(y0_new, X0_dists, X1_dists)
+            timer.add(term_0)
 
         # ### Term 1 Estimation (depending on all y1) ###
-        # X1_sorted:dim 0, y1_steps: dim 1
-        all_cdf_vals1, y1_cdf_candidate = self.cdf_1.getallcdfs(self.X1_sorted)
-        # X0: dim 0, y1_steps: dim 1
-        all_cdf_vals10 = self.cdf_1.getallcdfs(self.X0)[0]
-        if not same:
-            identity_vec = torch.tensor([0., 1.]).repeat_interleave(
-                torch.tensor([self.y1_sorted.shape[0], y1_cdf_candidate.shape[0]]))
-
-            # Set value
-            all_y1_candidate, all_sort_indices = torch.sort(torch.cat([self.y1_sorted, y1_cdf_candidate]))
-            identity_vec = identity_vec[all_sort_indices]
-            # Merging
-            # Append 0 to the start of each row
-            all_cdf_vals1 = torch.cat([torch.zeros(all_cdf_vals1.shape[0], 1), all_cdf_vals1], dim=1)
-            all_cdf_vals10 = torch.cat([torch.zeros(all_cdf_vals10.shape[0], 1), all_cdf_vals10], dim=1)
-
-            all_cdf_vals1_expanded = all_cdf_vals1[:, torch.cumsum(identity_vec, dim=0).int()]
-            all_cdf_vals10_expanded = all_cdf_vals10[:, torch.cumsum(identity_vec, dim=0).int()]
+        if getattr(self, "train_cdfs", None) is not None:
+            cdf_factors1, cdf_factors10, y1_cdf_candidate = self.train_cdfs
+            storage = self.cdf_storage
         else:
-            all_cdf_vals1_expanded = all_cdf_vals1
-            all_cdf_vals10_expanded = all_cdf_vals10
+            with stage(self.profiler, "nuisance_cdf1") as timer:
+                # X1_sorted:dim 0, y1_steps: dim 1
+                all_cdf_vals1, y1_cdf_candidate = self.cdf_1.getallcdfs(self.X1_sorted)
+                # X0: dim 0, y1_steps: dim 1
+                all_cdf_vals10 = self.cdf_1.getallcdfs(self.X0)[0]
+                timer.add(all_cdf_vals1, all_cdf_vals10)
+            # With n_bins only the grid columns are kept so query work scales with the grid size
+            cdf_factors1, cdf_factors10, y1_cdf_candidate = self._grid_cdfs((all_cdf_vals1,), (all_cdf_vals10,),
+                                                                            y1_cdf_candidate)
+            storage = "dense"
+        with stage(self.profiler, "merge") as timer:
             all_y1_candidate = y1_cdf_candidate
+            # With n_bins the CDF values are already kept on the grid and the indicator terms are summed over it
+            aligned = same or self.y1_grid is not None
+            if not aligned:
+                if self.compress_ties:
+                    # Union of the distinct step points, each taking the values at the last step point at or below it
+                    all_y1_candidate = torch.unique(torch.cat([self.y1_steps, y1_cdf_candidate]))
+                    cdf_index = torch.searchsorted(y1_cdf_candidate, all_y1_candidate.to(y1_cdf_candidate.dtype),
+                                                   right=True)
+                    indicator_index = torch.searchsorted(self.y1_steps, all_y1_candidate.to(self.y1_steps.dtype),
+                                                         right=True)
+                else:
+                    identity_vec = torch.tensor([0., 1.]).repeat_interleave(
+                        torch.tensor([self.y1_sorted.shape[0], y1_cdf_candidate.shape[0]]))
+
+                    # Set value
+                    all_y1_candidate, all_sort_indices = torch.sort(torch.cat([self.y1_sorted, y1_cdf_candidate]))
+                    identity_vec = identity_vec[all_sort_indices]
+                    cdf_index = torch.cumsum(identity_vec, dim=0).int()
+                    indicator_index = torch.cumsum(identity_vec == 0, dim=0).int()
+            if slow:
+                # The slow approach works with dense CDF values at every candidate
+                all_cdf_vals1_expanded = _expand_cdfs(cdf_factors1, storage)
+                all_cdf_vals10_expanded = _expand_cdfs(cdf_factors10, storage)
+                if not aligned:
+                    # Merging
+                    # Append 0 to the start of each row
+                    all_cdf_vals1_expanded = torch.cat([torch.zeros(all_cdf_vals1_expanded.shape[0], 1),
+                                                        all_cdf_vals1_expanded], dim=1)[:, cdf_index]
+                    all_cdf_vals10_expanded = torch.cat([torch.zeros(all_cdf_vals10_expanded.shape[0], 1),
+                                                         all_cdf_vals10_expanded], dim=1)[:, cdf_index]
+                timer.add(all_cdf_vals1_expanded, all_cdf_vals10_expanded)
+
+        with stage(self.profiler, "contraction") as timer:
+            if slow:
+                # y1: dim 0, all_y1_candidate: dim 1
+                all_Z1s = (self.y1_sorted.unsqueeze(-1) <= all_y1_candidate).float()
+                # # Get A=1 samples pseudo-outcome
+                # empty: dim 0, y/X1: dim 1, all_y_steps: dim 2
+                pseudo_outcome_1 = ((all_Z1s-all_cdf_vals1_expanded)/self.prop_scores1.unsqueeze(1)
+                                    + all_cdf_vals1_expanded)
+                # X_new: ..., y1_candidate: dim1
+                term_1 = torch.sum(X1_dists.unsqueeze(-1)*pseudo_outcome_1.unsqueeze(0), dim=-2)
+                term_10 = torch.sum(X0_dists.unsqueeze(-1)*all_cdf_vals10_expanded.unsqueeze(0), dim=-2)
+                term_1s = term_1+term_10
 
-        if slow:
-            # y1: dim 0, all_y1_candidate: dim 1
-            all_Z1s = (self.y1_sorted.unsqueeze(-1) <= all_y1_candidate).float()
-            # # Get A=1 samples pseudo-outcome
-            # empty: dim 0, y/X1: dim 1, all_y_steps: dim 2
-            pseudo_outcome_1 = ((all_Z1s-all_cdf_vals1_expanded)/self.prop_scores1.unsqueeze(1)+all_cdf_vals1_expanded)
-            # X_new: ..., y1_candidate: dim1
-            term_1 = torch.sum(X1_dists.unsqueeze(-1)*pseudo_outcome_1.unsqueeze(0), dim=-2)
-            term_10 = torch.sum(X0_dists.unsqueeze(-1)*all_cdf_vals10_expanded.unsqueeze(0), dim=-2)
-            term_1s = term_1+term_10
-
-        else:
-            # # Alternative approach
-            incidicator_term_1 = torch.cumsum(X1_dists/self.prop_scores1, dim=-1)
-            if not same:
-                # Append 0 to the start of each row
-                incidicator_term_1 = torch.cat([torch.zeros(incidicator_term_1.shape[0], 1), incidicator_term_1], dim=1)
-                # Expand out indicator term to match all_y1_candidate
-                incidicator_term_1_expanded = incidicator_term_1[:, torch.cumsum(identity_vec == 0, dim=0).int()]
             else:
-                incidicator_term_1_expanded = incidicator_term_1
-            cdf_pseudo_0 = (1-1/self.prop_scores1.unsqueeze(1))*all_cdf_vals1_expanded
-            cdf_pseudo_01 = all_cdf_vals10_expanded
-            cdf_term0 = torch.sum(X1_dists.unsqueeze(-1)*cdf_pseudo_0.unsqueeze(0), dim=-2)
-            cdf_term01 = torch.sum(X0_dists.unsqueeze(-1)*cdf_pseudo_01.unsqueeze(0), dim=-2)
-            term_1s = incidicator_term_1_expanded+cdf_term0+cdf_term01
+                # # Alternative approach
+                if feature_indicators is not None:
+                    incidicator_term_1 = (features_new @ feature_indicators[0])/normaliser
+                else:
+                    incidicator_term_1 = self._cumulate_y1(X1_dists/self.prop_scores1)
+                if not aligned:
+                    # Append 0 to the start of each row
+                    incidicator_term_1 = torch.cat([torch.zeros(incidicator_term_1.shape[0], 1), incidicator_term_1],
+                                                   dim=1)
+                    # Expand out indicator term to match all_y1_candidate
+                    incidicator_term_1_expanded = incidicator_term_1[:, indicator_index]
+                else:
+                    incidicator_term_1_expanded = incidicator_term_1
+                # Contract the query weights with the CDF values at the step points of cdf_1 (a matrix product in
+                # factored form) and only then expand to all_y1_candidate
+                if feature_indicators is not None and feature_cdfs is not None:
+                    cdf_terms = (features_new @ feature_cdfs[0])/normaliser
+                else:
+                    cdf_terms = (_contract_cdfs(X1_dists*(1-1/self.prop_scores1), cdf_factors1, storage)
+                                 + _contract_cdfs(X0_dists, cdf_factors10, storage))
+                if not aligned:
+                    cdf_terms = torch.cat([cdf_terms.new_zeros(cdf_terms.shape[0], 1), cdf_terms], dim=1)[:, cdf_index]
+                term_1s = incidicator_term_1_expanded+cdf_terms
+            timer.add(term_1s)
 
         hs = term_1s - term_0
         if isotonic:
-            temp_h = []
-            ir = IsotonicRegression()
-            for h_row in hs:
-                temp_h.append(torch.tensor(ir.fit_transform(np.arange(h_row.shape[0]), h_row)))
-            hs = torch.stack(temp_h, dim=0)
+            with stage(self.profiler, "isotonic") as timer:
+                hs = _isotonic_project(hs)
+                timer.add(hs)
         return hs, all_y1_candidate
 
     def predict(self, y0_new: TT, X_new: TT, sortcheck=False, linear=False,
-                isotonic=True, return_hvals=False, fsolve_kwargs=None, **kwargs):
+                isotonic=True, return_hvals=False, fsolve_kwargs=None, variants=None, **kwargs):
         """Give the g value for each y0_new, X_new pair.
 
+        Duplicate (y0_new, X_new) rows are only evaluated once unless `dedupe` is off (see `dedupe`) and no `cache` is
+        set.
+        Cached predictions are not invalidated when `cdf_0` or `cdf_1` are refit, clear `cache` if they are.
+
         Args:
             y0_new (torch.Tensor): New y0 value to predict g at.
             X_new (torch.Tensor): New X value to predict g at.
@@ -650,58 +1620,203 @@ class dr_learner(ABC):
             isotonic (bool, optional): Whether to project h values to isotonic vector. Defaults to True.
             fsolve_kwargs (dict, optional): Arguments to pass to scipy.optimize.fsolve in `linear=True`.
                                             Defaults to None.
+            variants (Iterable[str], optional): Names of g variants (keys of `g_variants`) to compute from a
+                                                single h computation. Overrides `linear` and `isotonic` when given.
+                                                Defaults to None.
             **kwargs: Additional arguments to pass to get_all_hs.
         Raises:
-            ValueError: Errors if step points are not sorted.
+            ValueError: Errors if step points are not sorted or an unknown variant is requested.
 
         Returns:
-            torch.Tensor: g values for each y0_new, X_new pair.
+            torch.Tensor: g values for each y0_new, X_new pair
+            (dict mapping each variant name to its output if `variants` is given).
         """
-        hs, y1_candidate = self.get_all_hs(y0_new, X_new, isotonic=isotonic, **kwargs)
+        dedupe = self.dedupe if self.dedupe is not None else getattr(self, "feature_indicators", None) is None
+        return dedupe_rows(self._predict, y0_new, X_new, cache=self.cache, dedupe=dedupe, sortcheck=sortcheck,
+                           linear=linear, isotonic=isotonic, return_hvals=return_hvals, fsolve_kwargs=fsolve_kwargs,
+                           variants=variants, **kwargs)
+
+    def _predict(self, y0_new: TT, X_new: TT, sortcheck=False, linear=False,
+                 isotonic=True, return_hvals=False, fsolve_kwargs=None, variants=None, **kwargs):
+        if variants is None:
+            hs, y1_candidate = self.get_all_hs(y0_new, X_new, isotonic=isotonic, **kwargs)
+        else:
+            unknown = set(variants) - set(g_variants)
+            if unknown:
+                raise ValueError(f"Unknown g variants {sorted(unknown)}, options are {list(g_variants)}.")
+            # Isotonic projection is applied here so raw h values are available too
+            hs, y1_candidate = self.get_all_hs(y0_new, X_new, isotonic=False, **kwargs)
         if sortcheck:
             if not torch.all(y1_candidate == torch.sort(y1_candidate)[0]):
                 raise ValueError("y1_candidate is not sorted.")
-        # If h kept discrete
-        if not linear:
-            # Get y1s which give sufficiently large h/ have sufficiently large CDF
-            valid_ys = torch.where(hs >= 0, y1_candidate, torch.tensor([torch.inf]))
-            # Find the smallest valid y1
-            out_vals = torch.min(valid_ys, dim=-1)[0]
-            # Correct for cases with no valid value which currently output inf
-            # Instead output maximum of all ys
-            # (This theoretically should happen as the largest y-val should always have eCDF 1).
-            out_ys = torch.minimum(out_vals, y1_candidate[-1])
-            if return_hvals:
-                return out_ys, self.get_single_h(y0_new, out_ys, X_new)
-            else:
-                return out_ys
-        # If h made continuous via linear interpolation
+        if variants is None:
+            with stage(self.profiler, "root_find"):
+                return _g_from_hs(self, hs, y1_candidate, y0_new, X_new, linear, return_hvals, fsolve_kwargs)
+
+        hs_iso = None
+        outputs = {}
+        for name in variants:
+            variant_isotonic, variant_linear = g_variants[name]
+            if variant_isotonic and hs_iso is None:
+                with stage(self.profiler, "isotonic") as timer:
+                    hs_iso = _isotonic_project(hs)
+                    timer.add(hs_iso)
+            with stage(self.profiler, "root_find"):
+                outputs[name] = _g_from_hs(self, hs_iso if variant_isotonic else hs, y1_candidate, y0_new, X_new,
+                                           variant_linear, return_hvals, fsolve_kwargs)
+        return outputs
+
+    def predict_smooth(self, y0_new: TT, X_new: TT, max_iter=50, tol=1e-6, return_hvals=False):
+        """Give the g value for each y0_new, X_new pair by a safeguarded Newton search over y1.
+
+        Requires `cdf_1` to be a `smooth_kernel_cdf` so h is evaluated at each iterate with work linear in the
+        training size rather than over the full step grid.
+
+        Args:
+            y0_new (torch.Tensor): New y0 value to predict g at.
+            X_new (torch.Tensor): New X value to predict g at.
+            max_iter (int, optional): Maximum number of Newton/bisection iterations. Defaults to 50.
+            tol (float, optional): Tolerance in y1 for stopping. Defaults to 1e-6.
+            return_hvals (bool, optional): Whether to return h values as well. Defaults to False.
+
+        Raises:
+            ValueError: Errors if `cdf_1` is not a `smooth_kernel_cdf`.
+
+        Returns:
+            torch.Tensor: g values for each y0_new, X_new pair.
+        """
+        if not isinstance(self.cdf_1, smooth_kernel_cdf):
+            raise ValueError("predict_smooth requires cdf_1 to be a smooth_kernel_cdf.")
+        X0_dists, X1_dists = self.get_y_weights(X_new)
+        with stage(self.profiler, "nuisance_cdf0") as timer:
+            # # Get contribution of A=0 samples (as in get_all_hs)
+            cdf_vals0 = self.cdf_0.cdf(y0_new.unsqueeze(-1), self.X0)
+            cdf_vals01 = self.cdf_0.cdf(y0_new.unsqueeze(-1), self.X1_sorted)
+            Z0 = (self.y0 <= y0_new.unsqueeze(-1)).float()
+            term_0 = (torch.sum(X0_dists*((Z0-cdf_vals0)/self.prop_scores0+cdf_vals0), dim=-1)
+                      + torch.sum(X1_dists*cdf_vals01, dim=-1))
+            timer.add(cdf_vals0, cdf_vals01)
+
+        with stage(self.profiler, "nuisance_cdf1") as timer:
+            # # Collapse the smoothed CDF terms of the A=1 contribution onto the CDF sample points
+            # X_new: dim 0, cdf_1 sample: dim 1
+            cdf_weights1 = self.cdf_1.get_y_weights(self.X1_sorted).to(X1_dists.dtype)
+            cdf_coefs = ((X1_dists*(1-1/self.prop_scores1)) @ cdf_weights1
+                         + X0_dists @ self.cdf_1.get_y_weights(self.X0).to(X0_dists.dtype))
+            timer.add(cdf_coefs)
+        # Indicator term as cumulative weights over y1_sorted with a leading 0
+        indicator_cumul = torch.cumsum(X1_dists/self.prop_scores1, dim=-1)
+        indicator_cumul = torch.cat([torch.zeros_like(indicator_cumul[:, :1]), indicator_cumul], dim=-1)
+        y1_sorted = self.y1_sorted.to(cdf_coefs.dtype)
+        y_cdf = self.cdf_1.y_sorted.to(cdf_coefs.dtype)
+
+        def h_func(y_opt):
+            y_diff = y_opt.unsqueeze(-1)-y_cdf
+            n_below = torch.searchsorted(y1_sorted, y_opt.unsqueeze(-1).contiguous(), right=True)
+            indicator = torch.gather(indicator_cumul, -1, n_below).squeeze(-1)
+            cdf_vals = torch.sum(cdf_coefs*torch_normcdf(y_diff/self.cdf_1.y_bandwidth), dim=-1)
+            return indicator+cdf_vals-term_0, torch.sum(cdf_coefs*self.cdf_1._y_density(y_diff), dim=-1)
+
+        y_min = torch.minimum(y1_sorted[0], y_cdf[0])
+        y_max = torch.maximum(y1_sorted[-1], y_cdf[-1])
+        bandwidth = self.cdf_1.y_bandwidth
+        lo = torch.full_like(term_0, (y_min-10*bandwidth).item())
+        hi = torch.full_like(term_0, (y_max+10*bandwidth).item())
+        start = torch.full_like(term_0, y1_sorted[y1_sorted.shape[0]//2].item())
+        with stage(self.profiler, "root_find") as timer:
+            _, _, out_ys = _safeguarded_newton(h_func, lo, hi, start, max_iter, tol)
+            timer.add(out_ys)
+        # Rows with no valid value output the maximum y (as in predict)
+        out_ys = torch.clamp(out_ys, y_min, y_max)
+        if return_hvals:
+            return out_ys, h_func(out_ys)[0]
+        return out_ys
+
+
+# Variants of g available from dr_learner.predict mapped to their (isotonic, linear) settings.
+g_variants = {
+    "raw": (False, False),
+    "isotonic": (True, False),
+    "linear": (False, True),
+    "isotonic_linear": (True, True),
+}
+
+
+def _isotonic_project(hs: TT) -> TT:
+    """Project each row of h values onto a non-decreasing vector.
+
+    Args:
+        hs (torch.Tensor): h values with final dim representing all step points.
+
+    Returns:
+        torch.Tensor: Isotonic h values.
+    """
+    temp_h = []
+    ir = IsotonicRegression()
+    for h_row in hs:
+        temp_h.append(torch.tensor(ir.fit_transform(np.arange(h_row.shape[0]), h_row)))
+    return torch.stack(temp_h, dim=0)
+
+
+def _g_from_hs(learner, hs: TT, y1_candidate: TT, y0_new: TT, X_new: TT, linear=False,
+               return_hvals=False, fsolve_kwargs=None):
+    """Find the root in y1 of already computed h values.
+
+    Args:
+        learner: Fitted learner the h values came from (used for `get_single_h` if `return_hvals`).
+        hs (torch.Tensor): h values with final dim representing all step points.
+        y1_candidate (torch.Tensor): y1 step values used for h values.
+        y0_new (torch.Tensor): y0 values h was computed for.
+        X_new (torch.Tensor): X values h was computed for.
+        linear (bool, optional): Whether to linearly interpolate between step points. Defaults to False.
+        return_hvals (bool, optional): Whether to return h values as well. Defaults to False.
+        fsolve_kwargs (dict, optional): Arguments to pass to scipy.optimize.fsolve in `linear=True`.
+                                        Defaults to None.
+
+    Returns:
+        torch.Tensor: g values for each y0_new, X_new pair.
+    """
+    # If h kept discrete
+    if not linear:
+        # Get y1s which give sufficiently large h/ have sufficiently large CDF
+        valid_ys = torch.where(hs >= 0, y1_candidate, torch.tensor([torch.inf]))
+        # Find the smallest valid y1
+        out_vals = torch.min(valid_ys, dim=-1)[0]
+        # Correct for cases with no valid value which currently output inf
+        # Instead output maximum of all ys
+        # (This theoretically should happen as the largest y-val should always have eCDF 1).
+        out_ys = torch.minimum(out_vals, y1_candidate[-1])
+        if return_hvals:
+            return out_ys, learner.get_single_h(y0_new, out_ys, X_new)
         else:
-            if fsolve_kwargs is None:
-                fsolve_kwargs = {}
-            if len(hs.shape) > 2:
-                raise ValueError("Continuous prediction doesn't support additional batching dimensions.")
-            results = []
-            h_out = []
-            # Iterate over each y_0 sample and associated h values
-            for h_sub in hs:
-                # Define function to optimise over y_1 as linear interpolation of h values
-                def h_opt(y_opt):
-                    return np.interp(y_opt, y1_candidate, h_sub)
-                # Solve for y_1
-                # Ensure start point comfortably inside interpolation region
-                start_point = y1_candidate[y1_candidate.shape[0]//2]
-                sol, infodict, ier, mesg = fsolve(h_opt, start_point, full_output=True, **fsolve_kwargs)
-                results.append(torch.tensor(sol))
-                h_out.append(torch.tensor(infodict['fvec']))
-
-            # Combine values and clamp to ensure no strange behaviour outside interpolation region
-            y_out = torch.clamp(torch.cat(results, dim=0), y1_candidate[0], y1_candidate[-1])
-            h_out = torch.cat(h_out, dim=0)
-            if return_hvals:
-                return y_out, h_out
-            else:
-                return y_out
+            return out_ys
+    # If h made continuous via linear interpolation
+    else:
+        if fsolve_kwargs is None:
+            fsolve_kwargs = {}
+        if len(hs.shape) > 2:
+            raise ValueError("Continuous prediction doesn't support additional batching dimensions.")
+        results = []
+        h_out = []
+        # Iterate over each y_0 sample and associated h values
+        for h_sub in hs:
+            # Define function to optimise over y_1 as linear interpolation of h values
+            def h_opt(y_opt):
+                return np.interp(y_opt, y1_candidate, h_sub)
+            # Solve for y_1
+            # Ensure start point comfortably inside interpolation region
+            start_point = y1_candidate[y1_candidate.shape[0]//2]
+            sol, infodict, ier, mesg = fsolve(h_opt, start_point, full_output=True, **fsolve_kwargs)
+            results.append(torch.tensor(sol))
+            h_out.append(torch.tensor(infodict['fvec']))
+
+        # Combine values and clamp to ensure no strange behaviour outside interpolation region
+        y_out = torch.clamp(torch.cat(results, dim=0), y1_candidate[0], y1_candidate[-1])
+        h_out = torch.cat(h_out, dim=0)
+        if return_hvals:
+            return y_out, h_out
+        else:
+            return y_out
 
 
 class conditional_pdf(ABC):
@@ -716,19 +1831,90 @@ class conditional_pdf(ABC):
     def nested_outcome_func(self, quantiles, X, Y):
         return self.cond_density_kernel(Y-quantiles)
 
-    def fit(self, y: TT, X: TT, alpha: float):
+    def fit(self, y: TT, X: TT, alpha: float, sample_weight: TT = None, collapse=False):
+        """Fit the density regression to the smoothed outcomes at the alpha-quantile.
+
+        Args:
+            y (torch.Tensor): y values to fit to.
+            X (torch.Tensor): x values to fit to (final dim is dimension of x values).
+            alpha (float): Quantile level to estimate the density at.
+            sample_weight (torch.Tensor, optional): Weight of each row, passed to the density regression's `fit`
+                                                    (which must then accept a `sample_weight` argument).
+                                                    Defaults to None (unit weights).
+            collapse (bool, optional): Whether to collapse duplicate (y, x) rows into single weighted rows
+                                       (giving the same estimates). Defaults to False.
+        """
+        if collapse:
+            y, X, sample_weight = _collapse_duplicates(y, X, _sample_weights(sample_weight, X))
         self.y = y
         self.X = X
         self.alpha = torch.tensor(alpha)
         quantile_vals = self.cdf.inverse_cdf(self.alpha, self.X)
         outputs = self.nested_outcome_func(quantile_vals, self.X, self.y)
-        self.density_regression.fit(self.X, outputs)
+        if sample_weight is None:
+            self.density_regression.fit(self.X, outputs)
+        else:
+            self.density_regression.fit(self.X, outputs, sample_weight=sample_weight)
 
     def predict(self, X_new: TT):
         return self.density_regression.predict(X_new)
 
 
+class kernel_conditional_pdf(ABC):
+    """Conditional density at the alpha-quantile taken directly from the weights of a fitted kernel_cdf.
+
+    The density is estimated by smoothing the kernel CDF weights in the y direction around the
+    alpha-quantile so no separate density regression needs to be fit. Sample weights (and collapsed duplicate
+    rows) are those the CDF was fitted with.
+    """
+    def __init__(self, cdf: kernel_cdf, h: float = 1):
+        """Initialise with the fitted CDF and the bandwidth for smoothing in y.
+
+        Args:
+            cdf (kernel_cdf): Estimated CDF already fitted.
+            h (float, optional): Bandwidth of the kernel used to smooth in y. Defaults to 1.
+        """
+        self.cdf = cdf
+        self.h = h
+
+    @staticmethod
+    def cond_density_kernel(x: TT, h=1):
+        return 1/h * torch.exp(-x**2/h**2/2)
+
+    def fit(self, y: TT, X: TT, alpha: float):
+        """Set the quantile level (the data is already held by the fitted CDF).
+
+        Args:
+            y (torch.Tensor): y values (not used).
+            X (torch.Tensor): x values (not used).
+            alpha (float): Quantile level to estimate the density at.
+        """
+        self.y = y
+        self.X = X
+        self.alpha = torch.tensor(alpha)
+
+    def predict(self, X_new: TT):
+        """Estimate the conditional density at the alpha-quantile for each X_new.
+
+        Args:
+            X_new (torch.Tensor): X values to estimate the density for.
+
+        Returns:
+            torch.Tensor: Density estimate for each X_new.
+        """
+        y_weights = self.cdf.get_y_weights(X_new)
+        cumul_weights = torch.cumsum(y_weights, dim=-1)
+        alpha = self.alpha.to(cumul_weights.dtype).expand(cumul_weights.shape[0], 1).contiguous()
+        # Index of the alpha-quantile in y_sorted matching kernel_cdf.inverse_cdf
+        quantile_index = torch.searchsorted(cumul_weights, alpha, right=self.cdf.supremum)
+        quantile_index.clamp_(max=self.cdf.y_sorted.shape[0]-1)
+        # X_new: dim 0, y_sorted: dim 1
+        quantile_vals = self.cdf.y_sorted[quantile_index]
+        return torch.sum(y_weights*self.cond_density_kernel(self.cdf.y_sorted-quantile_vals, self.h), dim=-1)
+
+
 class exact_conditional_pdf(ABC):
+    """Known conditional density (no data is fitted so sample weights do not apply)."""
     def __init__(self, conditional_pdf):
         self.conditional_pdf = conditional_pdf
 
@@ -758,27 +1944,33 @@ class dr_learner_quantile_static(ABC):
         self.pdf_1 = pdf_1
         self.prop_func = prop_func
 
-    def fit(self, y0: TT, X0: TT, y1: TT, X1: TT, alpha: float):
+    def fit(self, y0: Union[TT, sorted_sample], X0: TT, y1: Union[TT, sorted_sample], X1: TT, alpha: float,
+            sample_weight0: TT = None, sample_weight1: TT = None, collapse=False):
         """Fit the pseudo IPW model to the given data.
 
         Args:
-            y0 (torch.Tensor): y0 values to fit to.
+            y0 (torch.Tensor|sorted_sample): y0 values to fit to, or a sorted_sample of the A=0 data (with X0 None).
             X0 (torch.Tensor): x0 values to fit to (final dim is dimension of x values).
-            y1 (torch.Tensor): y1 values to fit to.
+            y1 (torch.Tensor|sorted_sample): y1 values to fit to, or a sorted_sample of the A=1 data (with X1 None).
             X1 (torch.Tensor): x1 values to fit to (final dim is dimension of x values).
+            alpha (float): Quantile level.
+            sample_weight0 (torch.Tensor, optional): Weight of each A=0 row. Defaults to None (unit weights).
+            sample_weight1 (torch.Tensor, optional): Weight of each A=1 row. Defaults to None (unit weights).
+            collapse (bool, optional): Whether to collapse duplicate (y, x) rows into single weighted rows
+                                       (giving the same estimates). Defaults to False.
         """
+        sample0 = _as_sample(y0, X0, sample_weight0, collapse)
+        sample1 = _as_sample(y1, X1, sample_weight1, collapse)
         self.y1_sorted: TT
-        self.y0 = y0
-        self.X0 = X0
-        self.y1_sorted, self.sort_indices_1 = torch.sort(y1)
-        self.X1_sorted = X1[self.sort_indices_1, :]
-        # Get propensity scores if necessary
-        if self.prop_func is not None:
-            self.prop_scores0 = 1-self.prop_func(self.X0)
-            self.prop_scores1 = self.prop_func(self.X1_sorted)
-        else:  # If no propensity scores then just use 0.5
-            self.prop_scores0 = torch.ones_like(self.X0[:, 0])-.5
-            self.prop_scores1 = torch.ones_like(self.X1_sorted[:, 0])-.5
+        self.y0 = sample0.y
+        self.X0 = sample0.X
+        self.sample_weights0 = sample0.sample_weights
+        self.y1_sorted, self.sort_indices_1 = sample1.y_sorted, sample1.sort_indices
+        self.X1_sorted = sample1.X_sorted
+        self.sample_weights1 = sample1.sample_weights[self.sort_indices_1]
+        # Get propensity scores (0.5 if no propensity function)
+        self.prop_scores0 = 1-sample0.get_prop_scores(self.prop_func)
+        self.prop_scores1 = sample1.get_prop_scores(self.prop_func)[self.sort_indices_1]
         self.alpha = torch.tensor(alpha)
 
         # y0/1_new: dim 0, X0/1: dim 1.
@@ -802,15 +1994,19 @@ class dr_learner_quantile_static(ABC):
         Args:
             X_new (torch.Tensor): Tensor of new X values to get weights for.
 
+        Raises:
+            ValueError: Errors if a query row has zero total kernel weight on the training rows.
+
         Returns:
             torch.Tensor: Tensor of weights
         """
-        X0_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X0.numpy()))
-        X1_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X1_sorted.numpy()))
+        X0_dists = cached_gram(self.kernel, X_new, self.X0)*self.sample_weights0
+        X1_dists = cached_gram(self.kernel, X_new, self.X1_sorted)*self.sample_weights1
         normaliser = (
             torch.sum(X0_dists, dim=1, keepdim=True)
             + torch.sum(X1_dists, dim=1, keepdim=True))
         # Normalise
+        _check_normaliser(normaliser)
         X0_dists.div_(normaliser)
         X1_dists.div_(normaliser)
         return X0_dists, X1_dists
@@ -861,27 +2057,32 @@ class dr_learner_quantile(ABC):
     def nested_outcome_func(self, quantiles, X, Y):
         return self.cond_density_kernel(Y-quantiles)
 
-    def fit(self, y0: TT, X0: TT, y1: TT, X1: TT):
+    def fit(self, y0: Union[TT, sorted_sample], X0: TT, y1: Union[TT, sorted_sample], X1: TT,
+            sample_weight0: TT = None, sample_weight1: TT = None, collapse=False):
         """Fit the pseudo IPW model to the given data.
 
         Args:
-            y0 (torch.Tensor): y0 values to fit to.
+            y0 (torch.Tensor|sorted_sample): y0 values to fit to, or a sorted_sample of the A=0 data (with X0 None).
             X0 (torch.Tensor): x0 values to fit to (final dim is dimension of x values).
-            y1 (torch.Tensor): y1 values to fit to.
+            y1 (torch.Tensor|sorted_sample): y1 values to fit to, or a sorted_sample of the A=1 data (with X1 None).
             X1 (torch.Tensor): x1 values to fit to (final dim is dimension of x values).
+            sample_weight0 (torch.Tensor, optional): Weight of each A=0 row. Defaults to None (unit weights).
+            sample_weight1 (torch.Tensor, optional): Weight of each A=1 row. Defaults to None (unit weights).
+            collapse (bool, optional): Whether to collapse duplicate (y, x) rows into single weighted rows
+                                       (giving the same estimates). Defaults to False.
         """
+        sample0 = _as_sample(y0, X0, sample_weight0, collapse)
+        sample1 = _as_sample(y1, X1, sample_weight1, collapse)
         self.y1_sorted: TT
-        self.y0 = y0
-        self.X0 = X0
-        self.y1_sorted, self.sort_indices_1 = torch.sort(y1)
-        self.X1_sorted = X1[self.sort_indices_1, :]
-        # Get propensity scores if necessary
-        if self.prop_func is not None:
-            self.prop_scores0 = 1-self.prop_func(self.X0)
-            self.prop_scores1 = self.prop_func(self.X1_sorted)
-        else:  # If no propensity scores then just use 0.5
-            self.prop_scores0 = torch.ones_like(self.X0[:, 0])-.5
-            self.prop_scores1 = torch.ones_like(self.X1_sorted[:, 0])-.5
+        self.y0 = sample0.y
+        self.X0 = sample0.X
+        self.sample_weights0 = sample0.sample_weights
+        self.y1_sorted, self.sort_indices_1 = sample1.y_sorted, sample1.sort_indices
+        self.X1_sorted = sample1.X_sorted
+        self.sample_weights1 = sample1.sample_weights[self.sort_indices_1]
+        # Get propensity scores (0.5 if no propensity function)
+        self.prop_scores0 = 1-sample0.get_prop_scores(self.prop_func)
+        self.prop_scores1 = sample1.get_prop_scores(self.prop_func)[self.sort_indices_1]
 
     def get_y_weights(self, X_new: TT):
         """Get weights (normalised kernels) for each y value given a new X value.
@@ -889,15 +2090,19 @@ class dr_learner_quantile(ABC):
         Args:
             X_new (torch.Tensor): Tensor of new X values to get weights for.
 
+        Raises:
+            ValueError: Errors if a query row has zero total kernel weight on the training rows.
+
         Returns:
             torch.Tensor: Tensor of weights
         """
-        X0_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X0.numpy()))
-        X1_dists = torch.tensor(self.kernel.eval(X_new.numpy(), self.X1_sorted.numpy()))
+        X0_dists = cached_gram(self.kernel, X_new, self.X0)*self.sample_weights0
+        X1_dists = cached_gram(self.kernel, X_new, self.X1_sorted)*self.sample_weights1
         normaliser = (
             torch.sum(X0_dists, dim=1, keepdim=True)
             + torch.sum(X1_dists, dim=1, keepdim=True))
         # Normalise
+        _check_normaliser(normaliser)
         X0_dists.div_(normaliser)
         X1_dists.div_(normaliser)
         return X0_dists, X1_dists
@@ -939,6 +2144,9 @@ class dr_learner_quantile(ABC):
 
 class separate_learner(ABC):
     """A class to perform separate kernel regression for each treatment group."""
+    # Set to an `instrument.profiler` to record the time spent in each stage of evaluation
+    profiler = None
+
     def __init__(self, cdf_0: kernel_cdf, cdf_1: kernel_cdf):
         """Initialise the separate learner with the given CDFs.
 
@@ -976,8 +2184,12 @@ class separate_learner(ABC):
             torch.Tensor: h values with final dim representing all step points, y1 step values used for h values
             torch.Tensor: y1 step values used for h values
         """
-        all_cdfs_1, y_1_candidate = self.cdf_1.getallcdfs(X)
-        cdf_0 = self.cdf_0.cdf(y_0, X)
+        with stage(self.profiler, "nuisance_cdf1") as timer:
+            all_cdfs_1, y_1_candidate = self.cdf_1.getallcdfs(X)
+            timer.add(all_cdfs_1)
+        with stage(self.profiler, "nuisance_cdf0") as timer:
+            cdf_0 = self.cdf_0.cdf(y_0, X)
+            timer.add(cdf_0)
         return all_cdfs_1 - cdf_0.unsqueeze(-1), y_1_candidate
 
     def predict(self, y_0: TT, X: TT, **kwargs):
@@ -998,7 +2210,7 @@ class separate_learner(ABC):
         Returns:
             torch.Tensor: g values for each y0_new, X_new pair.
         """
-        return dr_learner.predict(self, y_0, X, linear=False, isotonic=False)
+        return dr_learner._predict(self, y_0, X, linear=False, isotonic=False)
 
 
 class separate_quantile_learner(ABC):
@@ -0,0 +1,295 @@
+"""Saving and loading of fitted learners as a directory of `.npy` arrays plus a JSON manifest.
+
+Arrays are stored raw so they can be memory-mapped on load, letting a large fitted model be warm-started without
+copying its data. Nested fitted objects from this package (CDFs, kernels, propensity regressors) are stored in the
+manifest with shared references preserved, anything else (e.g. sklearn models) falls back to pickle.
+The same description is used by `shared_learner` to publish a fitted learner's arrays into shared memory.
+"""
+import importlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import uuid
+import warnings
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import torch
+from .caching import row_cache
+from .instrument import profiler
+
+FORMAT_NAME = "nonparamcdf-learner"
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+_PACKAGE = __name__.split(".")[0]
+# Byte alignment of arrays within a shared memory segment
+_ALIGN = 64
+# Shared memory segments attached in this process (kept open for the lifetime of the process)
+_attached_segments = {}
+_attach_lock = threading.Lock()
+
+
+def _flatten(learner):
+    """Describe a fitted learner as a JSON-serialisable manifest plus a dictionary of arrays.
+
+    Args:
+        learner: Fitted learner (or any object from this package) to describe.
+
+    Returns:
+        dict: Manifest describing the object graph with arrays referenced by name,
+        dict: Arrays (numpy) keyed by name,
+        dict: Objects to pickle keyed by name.
+    """
+    arrays = {}
+    pickles = {}
+    objects = {}
+    memo = {}
+
+    def describe(value, path):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return {"type": "value", "value": value}
+        if isinstance(value, (profiler, row_cache)):
+            # Profiling state and cached predictions are not part of the fitted model
+            return {"type": "value", "value": None}
+        if isinstance(value, torch.Tensor):
+            if id(value) not in memo:
+                memo[id(value)] = name = f"a{len(arrays)}"
+                arrays[name] = value.detach().cpu().numpy()
+            return {"type": "tensor", "array": memo[id(value)]}
+        if isinstance(value, np.ndarray):
+            if id(value) not in memo:
+                memo[id(value)] = name = f"a{len(arrays)}"
+                arrays[name] = value
+            return {"type": "ndarray", "array": memo[id(value)]}
+        if isinstance(value, (list, tuple)):
+            return {"type": type(value).__name__,
+                    "items": [describe(item, f"{path}[{i}]") for i, item in enumerate(value)]}
+        if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+            return {"type": "dict", "items": {key: describe(item, f"{path}.{key}") for key, item in value.items()}}
+        if type(value).__module__.split(".")[0] == _PACKAGE and hasattr(value, "__dict__"):
+            if id(value) not in memo:
+                memo[id(value)] = key = f"o{len(objects)}"
+                # Register before describing attributes so cyclic references resolve
+                objects[key] = {"class": f"{type(value).__module__}:{type(value).__qualname__}"}
+                objects[key]["attrs"] = {attr: describe(item, f"{path}.{attr}")
+                                         for attr, item in vars(value).items()}
+            return {"type": "object", "ref": memo[id(value)]}
+        try:
+            pickled = pickle.dumps(value)
+        except Exception as error:
+            raise TypeError(f"Cannot serialise attribute {path} of type {type(value).__name__}.") from error
+        name = f"p{len(pickles)}"
+        pickles[name] = pickled
+        return {"type": "pickle", "pickle": name}
+
+    manifest = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "root": describe(learner, "learner"),
+        "objects": objects,
+        "arrays": {name: {"dtype": array.dtype.str, "shape": list(array.shape)} for name, array in arrays.items()},
+        "pickles": list(pickles),
+    }
+    return manifest, arrays, pickles
+
+
+def _rebuild(manifest: dict, arrays: dict, pickles: dict):
+    """Rebuild a learner from its manifest, arrays and pickled objects (inverse of `_flatten`).
+
+    Args:
+        manifest (dict): Manifest from `_flatten`.
+        arrays (dict): Arrays keyed by name (may be memory-mapped, they are not copied).
+        pickles (dict): Pickled objects keyed by name.
+
+    Raises:
+        ValueError: Errors if the manifest is not of a supported format or version.
+
+    Returns:
+        The rebuilt learner.
+    """
+    if manifest.get("format") != FORMAT_NAME:
+        raise ValueError("Not a saved nonparamcdf learner.")
+    if manifest["version"] > FORMAT_VERSION:
+        raise ValueError(f"Saved format version {manifest['version']} is newer than supported {FORMAT_VERSION}.")
+    built = {}
+
+    def build(spec):
+        kind = spec["type"]
+        if kind == "value":
+            return spec["value"]
+        if kind == "tensor":
+            return torch.from_numpy(np.asarray(arrays[spec["array"]]))
+        if kind == "ndarray":
+            return arrays[spec["array"]]
+        if kind in ("list", "tuple"):
+            items = [build(item) for item in spec["items"]]
+            return items if kind == "list" else tuple(items)
+        if kind == "dict":
+            return {key: build(item) for key, item in spec["items"].items()}
+        if kind == "object":
+            key = spec["ref"]
+            if key not in built:
+                module_name, qualname = manifest["objects"][key]["class"].split(":")
+                if module_name.split(".")[0] != _PACKAGE:
+                    raise ValueError(f"Refusing to rebuild object of class {module_name}:{qualname}.")
+                cls = importlib.import_module(module_name)
+                for part in qualname.split("."):
+                    cls = getattr(cls, part)
+                built[key] = obj = cls.__new__(cls)
+                obj.__dict__.update({attr: build(item) for attr, item in manifest["objects"][key]["attrs"].items()})
+            return built[key]
+        if kind == "pickle":
+            return pickle.loads(pickles[spec["pickle"]])
+        raise ValueError(f"Unknown entry type {kind} in manifest.")
+
+    return build(manifest["root"])
+
+
+def save_learner(learner, path: str) -> None:
+    """Save a fitted learner to a directory of `.npy` arrays plus a JSON manifest.
+
+    The learner is written to a temporary sibling directory which then replaces `path`, so an existing save is
+    swapped out whole (no stale files are left behind and learners memory-mapped from it stay valid).
+
+    Args:
+        learner: Fitted learner (e.g. `kernel_cdf`, `dr_learner`, `pseudo_ipw`) to save.
+        path (str): Directory to save to (created if necessary, replaced if it exists).
+    """
+    manifest, arrays, pickles = _flatten(learner)
+    path = os.path.normpath(path)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_path)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array, allow_pickle=False)
+        for name, pickled in pickles.items():
+            with open(os.path.join(tmp_path, f"{name}.pkl"), "wb") as file:
+                file.write(pickled)
+        with open(os.path.join(tmp_path, MANIFEST_FILE), "w") as file:
+            json.dump(manifest, file)
+        if os.path.exists(path):
+            # Directories can only be renamed over empty ones so the old save is moved aside first
+            old_path = f"{tmp_path}.old"
+            os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+
+
+def load_learner(path: str, mmap=True):
+    """Load a learner saved with `save_learner`.
+
+    Args:
+        path (str): Directory the learner was saved to.
+        mmap (bool, optional): Whether to memory-map arrays (copy-on-write) rather than read them into memory.
+                               Defaults to True.
+
+    Returns:
+        The loaded learner.
+    """
+    with open(os.path.join(path, MANIFEST_FILE)) as file:
+        manifest = json.load(file)
+    arrays = {}
+    for name, info in manifest["arrays"].items():
+        # Empty arrays cannot be memory-mapped
+        mmap_mode = "c" if mmap and np.prod(info["shape"]) > 0 else None
+        arrays[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+    pickles = {}
+    for name in manifest["pickles"]:
+        with open(os.path.join(path, f"{name}.pkl"), "rb") as file:
+            pickles[name] = file.read()
+    return _rebuild(manifest, arrays, pickles)
+
+
+def _attach_segment(name: str) -> shared_memory.SharedMemory:
+    """Attach to an existing shared memory segment once per process without registering it with the resource tracker.
+
+    Only the publishing process registers (and, on unlink, unregisters) the segment. The tracker is shared with forked
+    and spawned workers, so a worker unregistering after attaching would remove the publisher's registration.
+    """
+    with _attach_lock:
+        if name not in _attached_segments:
+            try:
+                segment = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # Before Python 3.13 attaching always registers the segment, so registration is skipped instead
+                register = resource_tracker.register
+                resource_tracker.register = lambda *args, **kwargs: None
+                try:
+                    segment = shared_memory.SharedMemory(name=name)
+                finally:
+                    resource_tracker.register = register
+            _attached_segments[name] = segment
+        return _attached_segments[name]
+
+
+class shared_learner:
+    """A fitted learner with its arrays published into (POSIX) shared memory.
+
+    The object itself is small and picklable so it can be sent to worker processes, each of which calls `attach`
+    to get a copy of the learner whose arrays are read-only views of the one shared segment.
+    """
+    def __init__(self, learner):
+        """Copy the arrays of a fitted learner into a new shared memory segment.
+
+        Args:
+            learner: Fitted learner (e.g. `kernel_cdf`, `dr_learner`, `pseudo_ipw`) to publish.
+        """
+        self.manifest, arrays, self.pickles = _flatten(learner)
+        self.offsets = {}
+        size = 0
+        for name, array in arrays.items():
+            size = -(-size // _ALIGN)*_ALIGN
+            self.offsets[name] = size
+            size += array.nbytes
+        self._segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.name = self._segment.name
+        for name, array in arrays.items():
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=self._segment.buf, offset=self.offsets[name])
+            view[...] = array
+            del view
+
+    def attach(self):
+        """Get the learner with its arrays as read-only views of the shared memory segment.
+
+        Returns:
+            The fitted learner.
+        """
+        segment = self._segment if getattr(self, "_segment", None) is not None else _attach_segment(self.name)
+        arrays = {}
+        for name, info in self.manifest["arrays"].items():
+            view = np.ndarray(info["shape"], dtype=np.dtype(info["dtype"]), buffer=segment.buf,
+                              offset=self.offsets[name])
+            view.flags.writeable = False
+            arrays[name] = view
+        with warnings.catch_warnings():
+            # Tensors are read-only views by design
+            warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+            return _rebuild(self.manifest, arrays, self.pickles)
+
+    def close(self):
+        """Release the publishing process's handle on the segment (attached learners remain valid)."""
+        if getattr(self, "_segment", None) is not None:
+            self._segment.close()
+            self._segment = None
+
+    def unlink(self):
+        """Remove the segment (from the publishing process), its memory is freed once every process has released it.
+
+        Raises:
+            ValueError: Errors if called from a process other than the publisher or after `close`.
+        """
+        if getattr(self, "_segment", None) is None:
+            raise ValueError("Only the publishing shared_learner can unlink its segment before closing.")
+        self._segment.unlink()
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_segment"] = None
+        return state
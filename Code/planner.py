@@ -0,0 +1,267 @@
+"""Shape based estimates of the memory and compute needed by learner calls, and chunk size planning.
+
+Estimates count the elements of the main intermediate tensors of each call so a call can be checked against a memory
+budget (and split into chunks of query rows, see `streaming.stream_predict`) before anything is computed.
+"""
+import logging
+import sys
+from . import nonparamcdf as npcdf
+
+logger = logging.getLogger(__name__)
+
+
+class cost_estimate:
+    """Estimate of the memory and floating point operations of a call, broken down into named stages.
+
+    Each stage has a part independent of the number of query rows (fixed) and a part per query row.
+    Persistent stages are held for the whole call, the peak adds the largest of the other (transient) stages.
+    """
+    def __init__(self, stages: dict, persistent: tuple, itemsize=8):
+        """Initialise with the stage sizes.
+
+        Args:
+            stages (dict): Stage name mapped to (fixed elements, elements per row, fixed flops, flops per row).
+            persistent (tuple): Names of stages whose tensors are held for the rest of the call.
+            itemsize (int, optional): Bytes per element. Defaults to 8.
+        """
+        self.stages = stages
+        self.persistent = persistent
+        self.itemsize = itemsize
+
+    def stage_bytes(self, n_rows: int) -> dict:
+        """Get the bytes of each stage for a call with n_rows query rows."""
+        return {name: (fixed+per_row*n_rows)*self.itemsize for name, (fixed, per_row, _, _) in self.stages.items()}
+
+    def peak_bytes(self, n_rows: int) -> int:
+        """Estimate the peak memory (in bytes) of a call with n_rows query rows."""
+        sizes = self.stage_bytes(n_rows)
+        held = sum(size for name, size in sizes.items() if name in self.persistent)
+        transient = [size for name, size in sizes.items() if name not in self.persistent]
+        return held + max(transient, default=0)
+
+    def flops(self, n_rows: int) -> int:
+        """Estimate the floating point operations of a call with n_rows query rows."""
+        return sum(fixed+per_row*n_rows for _, _, fixed, per_row in self.stages.values())
+
+    def max_rows(self, budget_bytes: int) -> int:
+        """Get the largest number of query rows whose estimated peak memory is within budget (0 if none)."""
+        held_fixed = held_per_row = 0
+        transient = []
+        for name, (fixed, per_row, _, _) in self.stages.items():
+            if name in self.persistent:
+                held_fixed += fixed*self.itemsize
+                held_per_row += per_row*self.itemsize
+            else:
+                transient.append((fixed*self.itemsize, per_row*self.itemsize))
+        # The peak is within budget only if the held stages plus each transient stage are within budget
+        max_rows = sys.maxsize
+        for fixed, per_row in transient or [(0, 0)]:
+            room = budget_bytes-held_fixed-fixed
+            if room < 0:
+                return 0
+            if held_per_row+per_row > 0:
+                max_rows = min(max_rows, room//(held_per_row+per_row))
+        return int(max_rows)
+
+    def report(self, n_rows: int) -> dict:
+        """Summarise the estimate for a call with n_rows query rows."""
+        return {
+            "n_rows": n_rows,
+            "peak_bytes": self.peak_bytes(n_rows),
+            "flops": self.flops(n_rows),
+            "stage_bytes": self.stage_bytes(n_rows),
+        }
+
+    def __str__(self):
+        lines = ["stage: fixed elements + elements per row (persistent*)"]
+        for name, (fixed, per_row, _, _) in self.stages.items():
+            marker = "*" if name in self.persistent else ""
+            lines.append(f"  {name}{marker}: {fixed} + {per_row}/row")
+        return "\n".join(lines)
+
+
+def _cdf_stage(cdf, n_points: int, d: int):
+    """Stage sizes of `cdf.cdf(y_new.unsqueeze(-1), X)` for X with n_points rows."""
+    if getattr(cdf, "feature_cdfs", None) is not None:
+        n_features, n_steps = cdf.feature_cdfs[0].shape
+        # Features and CDF values at every step point of the evaluation points, then one value per query row
+        return (n_points*(n_features+n_steps+1), n_points, 2*n_points*n_features*(n_steps+1), n_points)
+    if isinstance(cdf, npcdf.kernel_cdf):
+        n_cdf = cdf.y_sorted.shape[0]
+        # Weights of the evaluation points plus the (query row, point, step) indicator product
+        return (2*n_points*n_cdf, n_points*n_cdf, 2*n_points*n_cdf*d, 2*n_points*n_cdf)
+    return (0, n_points, 0, n_points)
+
+
+def _n_steps(cdf) -> int:
+    """Number of step points returned by `cdf.getallcdfs`."""
+    return getattr(cdf, "y_steps", cdf.y_sorted).shape[0]
+
+
+def _getallcdfs_stage(cdf, n_points: int, d: int):
+    """Stage sizes of `cdf.getallcdfs(X)` for X with n_points rows (all query independent)."""
+    n_cdf = cdf.y_sorted.shape[0]
+    n_steps = _n_steps(cdf)
+    if getattr(cdf, "feature_cdfs", None) is not None:
+        n_features = cdf.feature_cdfs[0].shape[0]
+        return n_points*(n_features+n_steps), 2*n_points*n_features*(n_steps+1)
+    if isinstance(cdf, npcdf.kernel_cdf):
+        elements = n_points*n_cdf+n_points*n_steps
+        flops = 2*n_points*n_cdf*d+n_points*n_cdf+n_points*n_steps
+        if isinstance(cdf, npcdf.smooth_kernel_cdf):
+            elements += n_cdf*n_steps
+            flops += 2*n_points*n_cdf*n_steps
+        return elements, flops
+    return n_points*n_steps, n_points*n_steps
+
+
+def estimate(learner, slow=False, check_same=False, isotonic=False, itemsize=8) -> cost_estimate:
+    """Estimate the cost of a learner's main evaluation call from the shapes of its fitted data.
+
+    Supported calls are `dr_learner.get_all_hs`/`predict`, `pseudo_ipw.get_all_hs`/`predict`,
+    `kernel_cdf.getallcdfs` and `kernel_regressor.predict`.
+
+    Args:
+        learner: Fitted learner.
+        slow (bool, optional): Whether the `slow` path of `dr_learner.get_all_hs` is used. Defaults to False.
+        check_same (bool, optional): Whether `dr_learner` CDF and learner data are the same (no step grid merging).
+                                     Defaults to False.
+        isotonic (bool, optional): Whether h values are projected to isotonic vectors. Defaults to False.
+        itemsize (int, optional): Bytes per element. Defaults to 8 (double precision).
+
+    Raises:
+        TypeError: Errors if the learner type is not supported.
+
+    Returns:
+        cost_estimate: The estimate.
+    """
+    if isinstance(learner, npcdf.dr_learner):
+        n0, d = learner.X0.shape
+        n1 = learner.X1_sorted.shape[0]
+        n1_steps = getattr(learner, "y1_steps", learner.y1_sorted).shape[0]
+        n_cdf1 = _n_steps(learner.cdf_1)
+        if getattr(learner, "y1_grid", None) is not None:
+            # Indicator and CDF values are summed over and kept on the grid
+            m = n1_steps = n_cdf1_kept = learner.y1_grid.shape[0]
+        else:
+            m = n_cdf1 if check_same else n1_steps+n_cdf1
+            n_cdf1_kept = n_cdf1
+        # Feature aggregates (see `dr_learner.fit`/`precompute`) replace the query kernel weights where available
+        feature_indicators = None if slow else getattr(learner, "feature_indicators", None)
+        feature_cdfs = (getattr(learner, "feature_cdfs", None)
+                        if getattr(learner, "train_cdfs", None) is not None else None)
+        features_only = feature_indicators is not None and feature_cdfs is not None and feature_cdfs[1] is not None
+        kernel_elements, kernel_flops = 0, 0
+        if feature_indicators is not None:
+            n_features = feature_indicators[3].shape[0]
+            kernel_elements, kernel_flops = n_features+1, n_features*d+2*n_features
+        if features_only:
+            # Query features contracted with the cumulative sums at each y0_new
+            stages = {"nuisance_cdf0": (0, 2*n_features+2, 0, 4*n_features)}
+        else:
+            kernel_elements += 2*(n0+n1)
+            kernel_flops += 2*(n0+n1)*d+3*(n0+n1)
+            cdf0_elements, cdf0_row, cdf0_flops, cdf0_row_flops = _cdf_stage(learner.cdf_0, n0+n1, d)
+            stages = {"nuisance_cdf0": (cdf0_elements, cdf0_row, cdf0_flops, cdf0_row_flops)}
+        stages = {"kernel": (0, kernel_elements, 0, kernel_flops), **stages}
+        rank = None
+        if getattr(learner, "train_cdfs", None) is not None:
+            if learner.cdf_storage == "svd":
+                rank = learner.train_cdfs[0][0].shape[1]
+                stages["train_cdfs"] = ((n0+n1+2*n_cdf1_kept)*rank, 0, 0, 0)
+            elif learner.cdf_storage == "cumulative":
+                # Both arms share the cumulative step weights summed over the features
+                rank = learner.train_cdfs[0][0].shape[1]
+                stages["train_cdfs"] = ((n0+n1+n_cdf1_kept)*rank, 0, 0, 0)
+            else:
+                stages["train_cdfs"] = ((n0+n1)*n_cdf1_kept, 0, 0, 0)
+        else:
+            elements1, flops1 = _getallcdfs_stage(learner.cdf_1, n1, d)
+            elements10, flops10 = _getallcdfs_stage(learner.cdf_1, n0, d)
+            if getattr(learner, "y1_grid", None) is not None:
+                # Grid columns copied out of the full values
+                elements1 += (n0+n1)*n_cdf1_kept
+            stages["train_cdfs"] = (elements1+elements10, 0, flops1+flops10, 0)
+        if slow:
+            # Dense CDF values expanded to every candidate
+            stages["merge"] = ((n0+n1)*(n_cdf1_kept if check_same else 2*m), 0, 0, 0)
+            stages["contraction"] = (2*n1*m, (n0+n1)*m+m, 3*n1*m, 2*(n0+n1)*m)
+        else:
+            # Query weights contracted with the (factored) CDF values before expanding to the candidates
+            stages["merge"] = (0, 0, 0, 0)
+            if feature_indicators is not None:
+                elements, flops = n1_steps, 2*n_features*n1_steps
+            else:
+                elements, flops = n1+n1_steps, n1+n1_steps
+            if feature_indicators is not None and feature_cdfs is not None:
+                elements, flops = elements+n_cdf1_kept, flops+2*n_features*n_cdf1_kept
+            elif rank is not None:
+                elements, flops = elements+n1+2*rank+n_cdf1_kept, flops+2*(n0+n1)*rank+2*rank*n_cdf1_kept
+            else:
+                elements, flops = elements+n1+n_cdf1_kept, flops+2*(n0+n1)*n_cdf1_kept
+            stages["contraction"] = (0, elements+2*m, 0, flops+m)
+        stages["output"] = (0, m, 0, m)
+        if isotonic:
+            stages["isotonic"] = (0, 2*m, 0, 10*m)
+        persistent = ("kernel", "train_cdfs", "merge", "output")
+    elif isinstance(learner, npcdf.pseudo_ipw):
+        n0, d = learner.X0.shape
+        n1 = learner.X1_sorted.shape[0]
+        n1_steps = getattr(learner, "y1_steps", learner.y1_sorted).shape[0]
+        stages = {
+            "kernel": (0, 2*(n0+n1), 0, 2*(n0+n1)*d+3*(n0+n1)),
+            "cumulative": (0, n1+n1_steps, 0, 2*n1+n1_steps+n0),
+        }
+        persistent = ("kernel",)
+    elif isinstance(learner, npcdf.kernel_cdf):
+        n, d = learner.X_sorted.shape
+        stages = {"kernel": (0, n, 0, 2*n*d+3*n)}
+        n_steps = _n_steps(learner)
+        if getattr(learner, "feature_cdfs", None) is not None:
+            # Query features contracted with the cumulative step weights summed over features
+            n_features = learner.feature_cdfs[0].shape[0]
+            stages = {"kernel": (0, n_features+n_steps, 0, 2*n_features*(n_steps+1))}
+        elif isinstance(learner, npcdf.smooth_kernel_cdf):
+            stages["steps"] = (n*n_steps, n_steps, 0, 2*n*n_steps)
+        else:
+            stages["steps"] = (0, n_steps, 0, n+n_steps)
+        persistent = ("kernel",)
+    elif isinstance(learner, npcdf.kernel_regressor):
+        n, d = learner.X.shape
+        if getattr(learner, "feature_sums", None) is not None:
+            n_features = learner.feature_sums[0].shape[0]
+            stages = {"kernel": (0, n_features, 0, 4*n_features)}
+        else:
+            stages = {"kernel": (0, 2*n, 0, 2*n*d+5*n)}
+        persistent = ()
+    else:
+        raise TypeError(f"No cost estimate available for {type(learner).__name__}.")
+    return cost_estimate(stages, persistent, itemsize)
+
+
+def plan_chunk_size(learner, budget_bytes: int, n_new: int = None, **estimate_kwargs) -> int:
+    """Choose the number of query rows per chunk so a call stays within a memory budget, and log the plan.
+
+    Args:
+        learner: Fitted learner (see `estimate`).
+        budget_bytes (int): Memory budget in bytes.
+        n_new (int, optional): Total number of query rows (the chunk size is capped at this). Defaults to None.
+        **estimate_kwargs: Additional arguments to pass to `estimate`.
+
+    Raises:
+        MemoryError: Errors if even a single query row is estimated to exceed the budget.
+
+    Returns:
+        int: Number of query rows per chunk.
+    """
+    cost = estimate(learner, **estimate_kwargs)
+    chunk_size = cost.max_rows(budget_bytes)
+    if chunk_size < 1:
+        raise MemoryError(f"A single query row needs an estimated {cost.peak_bytes(1)} bytes, "
+                          f"over the budget of {budget_bytes} bytes.\n{cost}")
+    if n_new is not None:
+        chunk_size = min(chunk_size, n_new)
+    report = cost.report(chunk_size)
+    logger.info("Planned %s call in chunks of %d rows: peak %.3g bytes, %.3g flops per chunk (budget %.3g bytes).",
+                type(learner).__name__, chunk_size, report["peak_bytes"], report["flops"], budget_bytes)
+    return chunk_size
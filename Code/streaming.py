@@ -0,0 +1,125 @@
+"""Chunked evaluation of learners over query sets too large to evaluate (or hold) at once."""
+import numpy as np
+import torch
+from typing import Callable, Iterable, Union
+from . import planner
+TT = torch.Tensor
+ArrayLike = Union[TT, np.ndarray, Iterable]
+
+
+def iter_chunks(data: ArrayLike, chunk_size: int):
+    """Yield successive chunks of rows of data as tensors.
+
+    Args:
+        data (torch.Tensor|numpy.ndarray|Iterable): Rows to split. Numpy arrays (including memory-mapped ones) are
+                                                    read one chunk at a time, any other iterable is assumed to
+                                                    already yield chunks.
+        chunk_size (int): Number of rows per chunk (ignored for iterables of chunks).
+
+    Yields:
+        torch.Tensor: Chunk of rows.
+    """
+    if isinstance(data, torch.Tensor):
+        yield from torch.split(data, chunk_size)
+    elif isinstance(data, np.ndarray):
+        for start in range(0, data.shape[0], chunk_size):
+            # Copy out so only this chunk of a memory-mapped array is held in memory
+            yield torch.from_numpy(np.array(data[start:start+chunk_size]))
+    else:
+        for chunk in data:
+            yield torch.as_tensor(chunk)
+
+
+def _write(out: Union[TT, np.ndarray], start: int, result):
+    """Write an output (the first element of tuple outputs) into a sink at a row offset."""
+    values = result[0] if isinstance(result, tuple) else result
+    out[start:start+values.shape[0]] = values if isinstance(out, torch.Tensor) else values.numpy()
+
+
+def stream_predict(predict_func: Callable, X_new: ArrayLike, y0_new: ArrayLike = None, chunk_size=1024,
+                   out: Union[TT, np.ndarray, dict] = None, memory_budget: int = None, **kwargs):
+    """Evaluate a prediction function chunk by chunk, bounding memory independently of the number of queries.
+
+    For `dr_learner` call `precompute` first so the nuisance CDFs at the training points are not recomputed for
+    every chunk.
+
+    Args:
+        predict_func (Callable): Function to evaluate, called as `predict_func(X_chunk, **kwargs)` or
+                                 `predict_func(y0_chunk, X_chunk, **kwargs)` if y0_new is given
+                                 (e.g. `kernel_regressor.predict`, `kernel_cdf.getallcdfs`, `dr_learner.predict`).
+        X_new (torch.Tensor|numpy.ndarray|Iterable): Query x values (see `iter_chunks`).
+        y0_new (torch.Tensor|numpy.ndarray|Iterable, optional): Query y0 values chunked alongside X_new.
+                                                               Defaults to None.
+        chunk_size (int, optional): Number of query rows per chunk. Defaults to 1024.
+        out (torch.Tensor|numpy.ndarray|dict, optional): Sink (e.g. a memory-mapped array) to write each chunk's
+                                                         output into at its row offset. For tuple outputs the first
+                                                         element is written. Dict outputs (e.g. `dr_learner.predict`
+                                                         with `variants`) need a dict of sinks with the same keys.
+                                                         Defaults to None.
+        memory_budget (int, optional): If given the chunk size is chosen by `planner.plan_chunk_size` to keep the
+                                       estimated peak memory of each chunk (for a method of a learner) within this
+                                       many bytes. Defaults to None.
+        **kwargs: Additional arguments to pass to predict_func.
+
+    Raises:
+        ValueError: Errors if y0_new and X_new chunks do not match in size or dict outputs have no matching sinks.
+
+    Yields:
+        Output of predict_func for each chunk.
+    """
+    if memory_budget is not None:
+        learner = getattr(predict_func, "__self__", None)
+        if learner is None:
+            raise ValueError("memory_budget requires predict_func to be a method of a fitted learner.")
+        estimate_kwargs = {key: kwargs[key] for key in ("slow", "check_same") if key in kwargs}
+        # dr_learner.predict projects to isotonic h by default
+        estimate_kwargs["isotonic"] = kwargs.get("isotonic", predict_func.__name__ == "predict")
+        chunk_size = planner.plan_chunk_size(learner, memory_budget, **estimate_kwargs)
+    X_chunks = iter_chunks(X_new, chunk_size)
+    y0_chunks = iter_chunks(y0_new, chunk_size) if y0_new is not None else None
+    start = 0
+    for X_chunk in X_chunks:
+        if y0_chunks is None:
+            result = predict_func(X_chunk, **kwargs)
+        else:
+            y0_chunk = next(y0_chunks, None)
+            if y0_chunk is None or y0_chunk.shape[0] != X_chunk.shape[0]:
+                raise ValueError("y0_new and X_new chunks must have the same number of rows.")
+            result = predict_func(y0_chunk, X_chunk, **kwargs)
+        if out is not None:
+            if isinstance(result, dict):
+                if not isinstance(out, dict) or set(out) != set(result):
+                    raise ValueError(f"Dict outputs need a dict of sinks with keys {sorted(result)}.")
+                for name, value in result.items():
+                    _write(out[name], start, value)
+            else:
+                _write(out, start, result)
+        start += X_chunk.shape[0]
+        yield result
+
+
+def stream_to(out: Union[TT, np.ndarray, dict], predict_func: Callable, X_new: ArrayLike, y0_new: ArrayLike = None,
+              chunk_size=1024, memory_budget: int = None, **kwargs):
+    """Evaluate a prediction function chunk by chunk writing all outputs into a sink.
+
+    Args:
+        out (torch.Tensor|numpy.ndarray|dict): Sink (e.g. a memory-mapped array) with one row per query (a dict of
+                                               sinks for dict outputs, see `stream_predict`).
+        predict_func (Callable): Function to evaluate (see `stream_predict`).
+        X_new (torch.Tensor|numpy.ndarray|Iterable): Query x values (see `iter_chunks`).
+        y0_new (torch.Tensor|numpy.ndarray|Iterable, optional): Query y0 values. Defaults to None.
+        chunk_size (int, optional): Number of query rows per chunk. Defaults to 1024.
+        memory_budget (int, optional): Memory budget in bytes to choose the chunk size from (see `stream_predict`).
+                                       Defaults to None.
+        **kwargs: Additional arguments to pass to predict_func.
+
+    Returns:
+        torch.Tensor|numpy.ndarray|dict: The filled sink(s).
+    """
+    for _ in stream_predict(predict_func, X_new, y0_new, chunk_size=chunk_size, out=out,
+                            memory_budget=memory_budget, **kwargs):
+        pass
+    for sink in (out.values() if isinstance(out, dict) else (out,)):
+        if isinstance(sink, np.memmap):
+            sink.flush()
+    return out
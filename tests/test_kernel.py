@@ -0,0 +1,33 @@
+"""Check the block product kernel for discrete covariates."""
+import os
+import sys
+import numpy as np
+import pytest
+import torch
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Code import kernel  # noqa: E402
+from Code import nonparamcdf as npcdf  # noqa: E402
+
+
+def _mixed_data(n, categories, seed=0):
+    """Rows of a category column followed by two continuous columns."""
+    gen = np.random.default_rng(seed)
+    return np.column_stack([gen.choice(categories, size=n), gen.random((n, 2))])
+
+
+def test_block_gauss_matches_product_kernel():
+    X1, X2 = _mixed_data(30, [0, 1, 2], seed=0), _mixed_data(40, [0, 1, 2], seed=1)
+    expected = (X1[:, :1] == X2[:, :1].T)*kernel.KGauss(0.5).eval(X1[:, 1:], X2[:, 1:])
+    block = kernel.KBlockGauss(0.5, [0])
+    np.testing.assert_allclose(block.eval(X1, X2), expected)
+    np.testing.assert_allclose(block.eval_symmetric(X2), block.eval(X2, X2))
+
+
+def test_block_gauss_unseen_category():
+    X_train, X_new = _mixed_data(50, [0, 1], seed=0), _mixed_data(10, [2], seed=1)
+    block = kernel.KBlockGauss(0.5, [0])
+    assert not np.any(block.eval(X_new, X_train))
+    cdf = npcdf.kernel_cdf(block)
+    cdf.fit(torch.as_tensor(X_train[:, 1]), torch.as_tensor(X_train))
+    with pytest.raises(ValueError, match="zero total kernel weight"):
+        cdf.cdf(torch.zeros(10, dtype=torch.float64), torch.as_tensor(X_new))
@@ -0,0 +1,85 @@
+"""Check saving fitted learners to disk and publishing them into shared memory."""
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import pytest
+import torch
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+from Code import kernel  # noqa: E402
+from Code import nonparamcdf as npcdf  # noqa: E402
+from Code.persist import MANIFEST_FILE, load_learner, save_learner  # noqa: E402
+
+# Run in a fresh interpreter so the resource tracker's output (it shares the interpreter's stderr) can be captured
+SHARED_SCRIPT = textwrap.dedent("""
+    import multiprocessing
+    import sys
+    import torch
+    sys.path.append({root!r})
+    from Code import kernel
+    from Code import nonparamcdf as npcdf
+    from Code.persist import shared_learner
+
+
+    def predict(args):
+        shared, X_new = args
+        return shared.attach().predict(X_new.sum(dim=1), X_new)
+
+
+    if __name__ == "__main__":
+        gen = torch.Generator().manual_seed(0)
+        X0 = torch.rand(100, 2, generator=gen, dtype=torch.float64)
+        X1 = torch.rand(100, 2, generator=gen, dtype=torch.float64)
+        y0, y1 = X0.sum(dim=1)+torch.randn(100, generator=gen, dtype=torch.float64), X1.sum(dim=1)
+        cdf_0 = npcdf.kernel_cdf(kernel.KGauss(0.1))
+        cdf_1 = npcdf.kernel_cdf(kernel.KGauss(0.1))
+        cdf_0.fit(y0, X0)
+        cdf_1.fit(y1, X1)
+        learner = npcdf.dr_learner(kernel.KGauss(0.1), cdf_0, cdf_1)
+        learner.fit(y0, X0, y1, X1)
+        chunks = list(torch.chunk(torch.rand(40, 2, generator=gen, dtype=torch.float64), 4))
+        shared = shared_learner(learner)
+        with multiprocessing.get_context({method!r}).Pool(2) as pool:
+            results = pool.map(predict, [(shared, X_new) for X_new in chunks])
+        assert all(torch.allclose(learner.predict(X_new.sum(dim=1), X_new), result)
+                   for X_new, result in zip(chunks, results))
+        # Attaching in the publisher must not disturb its registration either
+        shared.attach()
+        shared.unlink()
+""")
+
+
+@pytest.mark.parametrize("method", ["fork", "spawn"])
+def test_shared_learner_cleanup(tmp_path, method):
+    script = tmp_path/"shared.py"
+    script.write_text(SHARED_SCRIPT.format(root=ROOT, method=method))
+    result = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+    assert result.stderr == ""
+
+
+def test_save_over_existing_directory(tmp_path):
+    gen = torch.Generator().manual_seed(0)
+    X0 = torch.rand(50, 2, generator=gen, dtype=torch.float64)
+    X1 = torch.rand(50, 2, generator=gen, dtype=torch.float64)
+    y0, y1 = X0.sum(dim=1), X1.sum(dim=1)+torch.randn(50, generator=gen, dtype=torch.float64)
+    cdf_0 = npcdf.kernel_cdf(kernel.KGauss(0.1))
+    cdf_1 = npcdf.kernel_cdf(kernel.KGauss(0.1))
+    cdf_0.fit(y0, X0)
+    cdf_1.fit(y1, X1)
+    learner = npcdf.dr_learner(kernel.KGauss(0.1), cdf_0, cdf_1)
+    learner.fit(y0, X0, y1, X1)
+    path = tmp_path/"learner"
+    save_learner(learner, str(path))
+    # Overwrite the larger save with a smaller learner
+    save_learner(cdf_1, str(path))
+    with open(path/MANIFEST_FILE) as file:
+        manifest = json.load(file)
+    expected = {MANIFEST_FILE} | {f"{name}.npy" for name in manifest["arrays"]}
+    expected |= {f"{name}.pkl" for name in manifest["pickles"]}
+    assert set(os.listdir(path)) == expected
+    assert os.listdir(tmp_path) == ["learner"]
+    X_new = torch.rand(10, 2, generator=gen, dtype=torch.float64)
+    assert torch.equal(load_learner(str(path)).cdf(y1[:10], X_new), cdf_1.cdf(y1[:10], X_new))
@@ -0,0 +1,65 @@
+"""Check that fitted learners give the same results when evaluated from several threads at once."""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import torch
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Code import kernel  # noqa: E402
+from Code import nonparamcdf as npcdf  # noqa: E402
+from Code.caching import row_cache  # noqa: E402
+
+N_THREADS = 8
+N_CHUNKS = 32
+
+
+def _fitted_learners(n=200, d=2, seed=0):
+    """Fit supremum CDFs for both arms and a DR learner on top of them on simulated data."""
+    gen = torch.Generator().manual_seed(seed)
+    X0, X1 = torch.rand(n, d, generator=gen, dtype=torch.float64), torch.rand(n, d, generator=gen, dtype=torch.float64)
+    y0 = X0.sum(dim=1)+torch.randn(n, generator=gen, dtype=torch.float64)
+    y1 = X1.sum(dim=1)+torch.randn(n, generator=gen, dtype=torch.float64)
+    cdf_0 = npcdf.kernel_cdf(kernel.KGauss(0.1), supremum=True)
+    cdf_1 = npcdf.kernel_cdf(kernel.KGauss(0.1), supremum=True)
+    cdf_0.fit(y0, X0)
+    cdf_1.fit(y1, X1)
+    learner = npcdf.dr_learner(kernel.KGauss(0.1), cdf_0, cdf_1)
+    learner.fit(y0, X0, y1, X1)
+    return cdf_1, learner
+
+
+def _queries(n=N_CHUNKS*10, d=2, seed=1):
+    """Query chunks of (y0, x) rows."""
+    gen = torch.Generator().manual_seed(seed)
+    X_new = torch.rand(n, d, generator=gen, dtype=torch.float64)
+    y0_new = X_new.sum(dim=1)+torch.randn(n, generator=gen, dtype=torch.float64)
+    return list(zip(torch.chunk(y0_new, N_CHUNKS), torch.chunk(X_new, N_CHUNKS)))
+
+
+def _check_concurrent(func, chunks, exact=True):
+    """Evaluate func on every chunk serially and from a thread pool and check the results match."""
+    serial = [func(*chunk) for chunk in chunks]
+    with ThreadPoolExecutor(max_workers=N_THREADS) as pool:
+        concurrent = list(pool.map(lambda chunk: func(*chunk), chunks))
+    for expected, result in zip(serial, concurrent):
+        assert torch.equal(expected, result) if exact else torch.allclose(expected, result)
+
+
+def test_inverse_cdf_concurrent():
+    cdf_1, _ = _fitted_learners()
+    _check_concurrent(lambda y0_new, X_new: cdf_1.inverse_cdf(0.5, X_new), _queries())
+
+
+def test_dr_learner_predict_concurrent():
+    _, learner = _fitted_learners()
+    _check_concurrent(learner.predict, _queries())
+
+
+def test_shared_cache_concurrent():
+    cdf_1, learner = _fitted_learners()
+    cdf_1.cache = row_cache(maxsize=64)
+    learner.cache = row_cache(maxsize=64)
+    # Repeat the chunks so threads hit rows other threads have added to the caches (evicted rows are recomputed in
+    # different batches so results are only compared up to rounding)
+    chunks = _queries()*2
+    _check_concurrent(lambda y0_new, X_new: cdf_1.inverse_cdf(0.5, X_new), chunks, exact=False)
+    _check_concurrent(learner.predict, chunks, exact=False)